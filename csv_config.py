@@ -17,7 +17,51 @@ HAPI_HOME = 'home_csv/'
 title = 'HAPI CSV Server'
 api_datatype = 'file'
 floc={'dir':'home_csv'}
-hapi_handler = csv_hapireader.do_data_csv
+hapi_handler = csv_hapireader.iter_data_csv
 tags_allowed = [''] # no subparams allowed                                  
 loaded_config = True # required, used to verify config variables exists on load
 stream_flag=True # True = stream per file, False = process all then serve
+
+# Optional server tuning (defaults shown, see hapi_parser.optional_config)
+#server_mode = 'threaded' # 'threaded' = thread per request, 'pool' = worker pool
+                          # 'async' = asyncio event loop
+#pool_workers = 8         # 'pool' mode: number of worker threads
+#pool_queue_size = 32     # 'pool' mode: waiting connections before 503s
+#async_threads = 8        # 'async' mode: threads running data requests
+#async_queue_chunks = 8   # 'async' mode: 64 KiB chunks queued per client
+#keepalive_timeout = 5    # seconds idle keep-alive connections are held
+#compression = ['zstd', 'gzip'] # response encodings offered, [] = none
+#compress_min_size = 1024 # smaller buffered responses go uncompressed
+#gzip_level = 6           # 1 (fast) .. 9 (small)
+#zstd_level = 3           # 1 (fast) .. 19 (small), needs 'zstandard'
+#compressed_passthrough = False # compressed day files sent as they are
+#metadata_check_interval = 2 # seconds between metadata mtime checks,
+                             # -1 = re-read only on SIGHUP
+#metadata_max_age = 60    # seconds clients/CDNs may reuse capabilities,
+                          # catalog and info before revalidating (ETag)
+#cache_max_bytes = 64 << 20 # memory for cached data responses, 0 = off
+#cache_entry_max_bytes = 8 << 20 # larger data responses are not cached
+#cache_ttl = 3600         # seconds a cached data response is reused,
+#cache_ttl_recent = 60    # or this when time.max is within the last hour
+#cache_dir = '/var/tmp/hapi_cache' # spill responses evicted from memory
+#cache_disk_max_bytes = 1 << 30    # here, up to this many bytes
+#coalesce_requests = True # identical concurrent data requests share a reader
+#write_buffer_size = 128 << 10 # streamed data is written in blocks this big
+#write_flush_interval = 1.0    # or at least every this many seconds
+#file_index_interval = 10 # seconds between rescans of the data directories
+#file_template = '$Y/<id>.$Y$m$d.csv' # data file layout under data/[id]/,
+                          # fields $Y $m $d $j(day of year) $H(hour)
+#file_templates = {'cputemp': '$Y/<id>_$Y$m.csv'} # per dataset id
+#read_ahead_files = 2     # day files read ahead of the one being sent
+#read_threads = 4         # threads doing that read-ahead, 0 = none
+#sidecar_dir = '/var/tmp/hapi_sidecars' # column copies of the day
+                          # files, for parameter subsets (needs numpy)
+#sidecar_interval = 300   # seconds between sidecar conversion passes
+#pyramid_dir = '/var/tmp/hapi_pyramid' # min/max/mean at coarser cadences,
+                          # for x_customRequestOptions.resolution (needs numpy)
+#pyramid_levels = ['PT1M', 'PT10M', 'PT1H', 'P1D']
+#pyramid_interval = 300   # seconds between pyramid building passes
+#downsample_bins = ['PT1M', 'PT10M', 'PT1H', 'P1D'] # bins any request may ask
+                          # for, x_customRequestOptions.bin (needs numpy)
+#workers = 1              # pre-forked server processes (--workers N overrides)
+#drain_timeout = 30       # seconds each worker gets to finish on shutdown
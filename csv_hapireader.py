@@ -8,14 +8,32 @@ See accompanying 'csv_config.py' file for site-specific details.
 
 Assumes data is flat files in a directory hierarchy of:
     "data/[id]/YYYY/[id].YYYYMMDD.csv
+or another layout set by file_template / file_templates in the config file (see
+hapi_fileindex.py), e.g. one file per month or per hour.  Data files may also be compressed,
+as .csv.gz, .csv.zst or .csv.bz2.
 """
 
+import io
 import json
 import math
 import os
+from collections.abc import Generator
+from datetime import timedelta
 from pathlib import Path
 
-import dateutil
+import hapi_binning
+import hapi_fileindex
+import hapi_output
+import hapi_pyramid
+import hapi_reader
+import hapi_sidecar
+from hapi_time import parse_time
+
+# iter_data_csv yields records in chunks of about this many bytes
+CHUNK_SIZE = 64 * 1024
+
+# seek_time stops searching within this many bytes of the first record
+SEEK_SLACK = 4096
 
 
 def do_parameters_map(id: str, floc: dict, parameters: list[str]) -> dict:
@@ -70,22 +88,260 @@ def do_parameters_map(id: str, floc: dict, parameters: list[str]) -> dict:
     return param_dict
 
 
-def do_data_csv(
+def seek_time(f, size: int, key: bytes) -> int:
+    """Finds where to start reading a time-sorted CSV file for records at or after key.
+
+    Binary search over byte offsets: each probe seeks to the middle of the remaining range,
+    skips to the next line start and compares that record's leading timestamp with key.
+    Lines may have any length.  Once the range is down to SEEK_SLACK bytes the search stops,
+    so the returned offset is a line start at most about that far before the first record at
+    or after key.
+
+    Parameters:
+    ----------
+    f : binary file
+        Open data file; its position is left undefined.
+    size : int
+        File size in bytes.
+    key : bytes
+        Leading timestamp to look for, compared as bytes with the start of each record.
+
+    Returns:
+    -------
+    int
+        Byte offset of a line start to read from.
+    """
+    lo = 0
+    hi = size
+    while hi - lo > SEEK_SLACK:
+        mid = (lo + hi) // 2
+        f.seek(mid)
+        f.readline()  # realign to the next line start
+        pos = f.tell()
+        if pos >= hi:
+            hi = mid  # no line starts past mid
+            continue
+        rec = f.readline()
+        if rec[0:len(key)] < key:
+            lo = pos + len(rec)
+        else:
+            hi = pos
+    return lo
+
+
+def find_time(f, size: int, key: bytes) -> int:
+    """Byte offset of the first record at or after key (or size), found with seek_time.
+
+    Parameters and the state of f are as for seek_time.
+    """
+    pos = seek_time(f, size, key)
+    f.seek(pos)
+    while pos < size:
+        rec = f.readline()
+        if not rec or rec[0:len(key)] >= key:
+            break
+        pos += len(rec)
+    return min(pos, size)
+
+
+def file_span(f, first: bool, last: bool, keymin: bytes, keymax: bytes) -> tuple[int, int, bool]:
+    """Byte range of a data file holding its records in [keymin, keymax).
+
+    Only the first and last files of a request are searched; others are used whole.  Returns
+    (start, end, raw), where raw is False when the range cannot go out as it is on disk (CRLF
+    line ends, or a last record with no line end, e.g. one still being written).
+    """
+    head = f.readline()
+    raw = head.endswith(b"\n") and not head.endswith(b"\r\n")
+    size = os.fstat(f.fileno()).st_size
+    start = find_time(f, size, keymin) if first else 0
+    end = find_time(f, size, keymax) if last else size
+    if end <= start:
+        return (start, start, raw)
+    f.seek(end - 1)
+    if f.read(1) != b"\n":
+        raw = False
+    return (start, end, raw)
+
+
+def will_need(f, start: int, end: int) -> None:
+    """Asks the OS to start reading bytes start to end of f into its page cache."""
+    if end > start and hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(f.fileno(), start, end - start, os.POSIX_FADV_WILLNEED)
+
+
+def read_blocks(f, start: int, end: int) -> Generator[bytes, None, None]:
+    """Reads bytes start to end of f in blocks of about CHUNK_SIZE bytes of whole lines.
+
+    Every line of a block ends in LF: CRLF line ends become LF (as text mode would), and a last
+    line with no line end gets one.
+    """
+    f.seek(start)
+    left = end - start
+    carry = b""
+    while left > 0:
+        data = f.read(min(CHUNK_SIZE, left))
+        if not data:
+            break  # the file shrank
+        left -= len(data)
+        block = carry + data
+        cut = block.rfind(b"\n") + 1 if left > 0 else len(block)
+        (block, carry) = (block[:cut], block[cut:])
+        if block:
+            if not block.endswith(b"\n"):
+                block += b"\n"
+            yield block.replace(b"\r\n", b"\n")
+    if carry:
+        yield carry.replace(b"\r\n", b"\n") + b"\n"
+
+
+def read_decoded(f, encoding: str, first: bool, last: bool, keymin: bytes,
+                 keymax: bytes) -> Generator[bytes, None, None]:
+    """Decodes a compressed data file into blocks of whole lines holding its records in [keymin, keymax).
+
+    Blocks are as from read_blocks, but the file can only be read from its start, so on the
+    first and last files of a request each block is searched with find_time instead of the file.
+    Decoding stops at the first record at or after keymax.
+    """
+    with hapi_output.open_decoded(f, encoding) as dec:
+        carry = b""
+        while True:
+            data = dec.read(CHUNK_SIZE)
+            block = carry + data
+            cut = block.rfind(b"\n") + 1 if data else len(block)
+            (block, carry) = (block[:cut], block[cut:])
+            if block:
+                if not block.endswith(b"\n"):
+                    block += b"\n"
+                block = block.replace(b"\r\n", b"\n")
+                size = len(block)
+                buf = io.BytesIO(block)
+                start = find_time(buf, size, keymin) if first else 0
+                end = find_time(buf, size, keymax) if last else size
+                if start < size:
+                    first = False  # the rest is at or after keymin
+                if end > start:
+                    yield block[start:end]
+                if end < size:
+                    return
+            if not data:
+                return
+
+
+def project_block(block: bytes, cols: list[int]) -> bytes:
+    """Keeps the CSV columns cols, in that order, of every record in block.
+
+    block is whole lines, each ending in LF.  All of its fields are split in one call and every
+    output column is one strided slice of them, so there is no Python code per record.  Blocks
+    whose lines do not all have the same number of fields are done record by record, and lines
+    too short to hold cols (blank or damaged ones) are left out.
+    """
+    ncols = block.count(b",", 0, block.index(b"\n")) + 1
+    if max(cols) >= ncols or not hapi_sidecar.even_lines(block, ncols):
+        out = []
+        for rec in block.splitlines():
+            ss = rec.split(b",")
+            if len(ss) > max(cols):
+                out.append(b",".join([ss[li] for li in cols]) + b"\n")
+        return b"".join(out)
+    nlines = block.count(b"\n")
+    fields = block.replace(b"\n", b",").split(b",")
+    width = 2 * len(cols)  # each output field and the separator after it
+    out = [b","] * (width * nlines)
+    for (j, li) in enumerate(cols):
+        out[2 * j::width] = fields[li:nlines * ncols:ncols]
+    out[width - 1::width] = [b"\n"] * nlines
+    return b"".join(out)
+
+
+def iter_aggregates(
+    dataset,
+    plan,
+    cols: list[int],
+    catalog,
+    timemin: str,
+    timemax: str,
+) -> Generator[bytes, None, int]:
+    """
+    Yields the bins of a hapi_pyramid.Plan starting in [timemin, timemax), columns cols.
+
+    Pieces come from hapi_pyramid.PYRAMIDS when it keeps the resolution and has them built and
+    up to date, and are aggregated from the data files otherwise; either way through
+    hapi_reader.PREFETCH, like the files of iter_data_csv.  Returns 1200, 1201 (no bins) or
+    1500 when data files do not parse into columns.
+    """
+    pyramid = hapi_pyramid.PYRAMIDS
+    if pyramid is not None and plan.resolution not in pyramid.levels:
+        pyramid = None  # not kept, always aggregated here
+    dtypes = hapi_sidecar.column_dtypes(catalog)
+    fills = hapi_binning.column_fills(catalog)
+    keymin = timemin.encode("utf-8")
+    keymax = timemax.encode("utf-8")
+
+    def read_piece(piece):
+        (key, files) = piece
+        npz = None
+        if pyramid is not None:
+            npz = pyramid.load(dataset.datadir, plan.resolution, key, files)
+        if npz is not None:
+            with npz:
+                return hapi_sidecar.records(hapi_pyramid.Aggregates(npz, plan.aggregation), cols, keymin, keymax)
+        try:
+            arrays = hapi_pyramid.aggregate_files(files, dtypes, fills, plan.width)
+        except (OSError, EOFError, ValueError):
+            return None
+        if arrays is None:
+            return []
+        return hapi_sidecar.records(hapi_pyramid.Aggregates(arrays, plan.aggregation), cols, keymin, keymax)
+
+    status = 1201
+    pieces = hapi_pyramid.pieces(dataset, plan.width, timemin, timemax)
+    for blocks in hapi_reader.PREFETCH.map(read_piece, pieces):
+        if blocks is None:
+            return 1500
+        for block in blocks:
+            yield block
+            status = 1200
+    return status
+
+
+def iter_data_csv(
     id: str,
     timemin: str,
     timemax: str,
     parameters: list[str],
     catalog,
     floc: dict,
-    stream_flag: bool,
-    stream,
-) -> tuple[int, str]:
+) -> Generator[bytes, None, int]:
     """
-    Retrieves and filters CSV time-series data within a specified date range and parameter list.
+    Yields CSV time-series data within a specified date range and parameter list.
 
     Parses CSV files located within a dataset directory to extract data for specified parameters
-    and a time range. If streaming is enabled, writes the data incrementally to the stream object.
-    Returns a tuple with a status code and the final data string.
+    and a time range.  The data files overlapping the range are planned by hapi_fileindex from
+    the dataset's file layout.  The records in range of each file (all of it for interior
+    files, the part found by seek_time for the first and last files) are read in blocks of about CHUNK_SIZE
+    bytes (never spanning files), projected to the requested columns a block at a time by
+    project_block and yielded as UTF-8 bytes.  This is the hapi_reader generator form of reader;
+    see do_data_csv for the older one.
+
+    When all parameters are requested (every column, in order) and the window is in whole
+    seconds, each file's range is yielded as a hapi_reader.FileRange instead, which the server
+    sends as it is on disk.
+
+    Compressed data files (.csv.gz, .csv.zst, .csv.bz2) are decoded as they are read, by
+    read_decoded.  One whose records all fall in the window goes out as a FileRange of the
+    whole file with its encoding, so a response compressed the same way gets its bytes as they
+    are on disk.
+
+    Parameter subsets are read from a file's hapi_sidecar columns instead of its CSV text
+    when the server keeps them and they are up to date.
+
+    A request whose custom options ask for a resolution (see hapi_pyramid) gets one
+    aggregated record per bin instead, from iter_aggregates.
+
+    Files are read through hapi_reader.PREFETCH, so while one goes out to the client the next
+    few are read (or, for FileRanges, paged in) on other threads.  Memory use is bounded by
+    those few files, not by the length of the request.
 
     Parameters:
     ----------
@@ -97,10 +353,145 @@ def do_data_csv(
         End time for filtering records.
     parameters : list[str]
         List of parameter names to retrieve from the data files.
-    catalog : _
-        Not used
+    catalog : Mapping
+        Parsed info for the dataset.  When it is a hapi_metadata.DatasetMeta
+        its precomputed column map is used instead of re-reading the JSON.
     floc : dict
         Dictionary with a 'dir' key pointing to the base directory of the info file.
+
+    Yields:
+    ------
+    bytes
+        Whole CSV records.
+
+    Returns:
+    -------
+    int
+        Status code (1200 if data found, 1201 if no data for time range).
+    """
+    dataset = hapi_fileindex.INDEX.dataset(floc["dir"] + "/data/" + id)
+    dtmin = parse_time(timemin)
+    dtmax = parse_time(timemax)
+    # records are compared to the second, so files can only be sent as they
+    # are when the window needs no finer trimming
+    whole_seconds = dtmin.microsecond == 0 and dtmax.microsecond == 0
+    # records are matched to the second; a fractional timemax is rounded up
+    # so no record is lost, and the server trims the rest
+    if dtmax.microsecond:
+        dtmax += timedelta(seconds=1)
+    timemin = dtmin.strftime("%Y-%m-%dT%H:%M:%S")
+    timemax = dtmax.strftime("%Y-%m-%dT%H:%M:%S")
+
+    if parameters is not None and hasattr(catalog, "parameters_map"):
+        mm = catalog.parameters_map(parameters)
+    elif parameters is not None:
+        mm = do_parameters_map(id, floc, parameters)
+    else:
+        mm = None
+    # CSV columns to keep, in output order, or None for whole records
+    cols = None if mm is None else [li for i in mm for li in mm[i]]
+    if cols is not None and cols == list(range(getattr(catalog, "ncolumns", -1))):
+        # all parameters (what the server asks for when none are named)
+        # select every column in order, so records are kept whole
+        cols = None
+    passthrough = cols is None and whole_seconds
+    sidecars = hapi_sidecar.SIDECARS
+
+    plan = hapi_pyramid.plan(floc.get("customOptions", []))
+    if plan is not None:
+        if cols is None:
+            cols = list(range(len(hapi_sidecar.column_dtypes(catalog))))
+        return (yield from iter_aggregates(dataset, plan, cols, catalog, timemin, timemax))
+
+    files = dataset.lookup(timemin, timemax)
+    if files:
+        # the end files may hold nothing in range (records outside the
+        # time the file is named for); their first/last records are known
+        # to the index
+        (first, last) = files[0].bounds()
+        if last is not None and last[0:19] < timemin:
+            files = files[1:]
+    if files:
+        (first, last) = files[-1].bounds()
+        if first is not None and first[0:19] >= timemax:
+            files = files[:-1]
+
+    # records are compared as bytes, straight from the file
+    keymin = timemin.encode("utf-8")
+    keymax = timemax.encode("utf-8")
+
+    def read_file(datafile):
+        # runs ahead on a hapi_reader.PREFETCH thread: finds the file's
+        # range and, unless it goes out as it is on disk, reads it
+        if sidecars is not None and cols is not None:
+            npz = sidecars.load(dataset.datadir, datafile)
+            if npz is not None:
+                with npz:
+                    return (0, 0, hapi_sidecar.records(npz, cols, keymin, keymax))
+        (first, last) = (datafile is files[0], datafile is files[-1])
+        with open(datafile.path, "rb") as f:
+            if datafile.encoding is not None:
+                if passthrough and whole_file(datafile, first, last) and datafile.plain():
+                    will_need(f, 0, datafile.size)
+                    return (0, datafile.size, None)
+                (start, end) = (0, 0)
+                blocks = read_decoded(f, datafile.encoding, first, last, keymin, keymax)
+            else:
+                (start, end, raw) = file_span(f, first, last, keymin, keymax)
+                if end <= start or (passthrough and raw):
+                    will_need(f, start, end)
+                    return (start, end, None)
+                blocks = read_blocks(f, start, end)
+            out = []
+            for block in blocks:
+                if cols is not None:
+                    block = project_block(block, cols)
+                if block:
+                    out.append(block)
+            return (start, end, out)
+
+    def whole_file(datafile, first, last):
+        # True if all of the file's records are in [timemin, timemax)
+        (datafirst, datalast) = datafile.bounds()
+        if datafirst is None:
+            return False
+        return (not first or datafirst[0:19] >= timemin) and (not last or datalast[0:19] < timemax)
+
+    status = 1201  # status 1201 is HAPI "OK- no data for time range"
+    for (datafile, (start, end, blocks)) in zip(files, hapi_reader.PREFETCH.map(read_file, files)):
+        if blocks is not None:
+            for block in blocks:
+                yield block
+                status = 1200
+        elif end > start:
+            with open(datafile.path, "rb") as f:
+                yield hapi_reader.FileRange(f, start, end - start, datafile.encoding)
+            status = 1200
+
+    return status
+
+
+def do_data_csv(
+    id: str,
+    timemin: str,
+    timemax: str,
+    parameters: list[str],
+    catalog,
+    floc: dict,
+    stream_flag: bool,
+    stream,
+) -> tuple[int, str]:
+    """
+    Retrieves and filters CSV time-series data within a specified date range and parameter list.
+
+    Older (status, data) form of iter_data_csv, for callers outside the server.  If streaming
+    is enabled, writes the data incrementally to the stream object.  Returns a tuple with a
+    status code and the final data string.
+
+    Parameters:
+    ----------
+    id, timemin, timemax, parameters, catalog, floc
+        As for iter_data_csv.
     stream_flag : bool
         If True, enables data streaming to `stream`.
     stream : object
@@ -112,55 +503,21 @@ def do_data_csv(
         Status code (1200 if data found, 1201 if no data for time range) and the collected data
         string.
     """
-    ff = floc["dir"] + "/data/" + id + "/"
-    filemin = dateutil.parser.parse(timemin).strftime("%Y%m%d")
-    filemax = dateutil.parser.parse(timemax).strftime("%Y%m%d")
-    timemin = dateutil.parser.parse(timemin).strftime("%Y-%m-%dT%H:%M:%S")
-    timemax = dateutil.parser.parse(timemax).strftime("%Y-%m-%dT%H:%M:%S")
-    yrmin = int(timemin[0:4])
-    yrmax = int(timemax[0:4])
-
-    if parameters is not None:
-        mm = do_parameters_map(id, floc, parameters)
-    else:
-        mm = None
-
-    datastr = ""
-    status = 0
-    for yr in range(yrmin, yrmax + 1):
-        ffyr = ff + f"{yr:04d}"
-        if not os.path.exists(ffyr):
-            continue
-        files = sorted(os.listdir(ffyr))
-        for file in files:
-            ymd = file[-12:-4]
-            if filemin <= ymd <= filemax:
-                with open(Path(ffyr) / file, "r", encoding="utf-8") as f:
-                    for rec in f:
-                        ydmhms = rec[0:19]
-                        if timemin <= ydmhms < timemax:
-                            if mm is not None:
-                                ss = rec.split(",")
-                                comma = False
-                                for i in mm:
-                                    for li in mm[i]:
-                                        if comma:
-                                            datastr += ","
-                                        datastr += ss[li]
-                                        comma = True
-                                if list(mm.values())[-1][-1] < (len(ss) - 1):
-                                    datastr += "\n"
-                            else:
-                                datastr += rec
-
-                            if len(datastr) > 0:
-                                status = 1200
-                            if stream_flag:
-                                # Write then flush
-                                stream.wfile.write(bytes(datastr, "utf-8"))
-                                datastr = ""
-
-    if status != 1200 and len(datastr) == 0:
-        status = 1201  # status 1200 is HAPI "OK- no data for time range"
-
-    return status, datastr
+    records = iter_data_csv(id, timemin, timemax, parameters, catalog, floc)
+    parts = []
+    while True:
+        try:
+            chunk = next(records)
+        except StopIteration as done:
+            status = done.value
+            break
+        if isinstance(chunk, hapi_reader.FileRange):
+            if stream_flag:
+                chunk.send(stream.wfile)
+                continue
+            chunk = chunk.read()
+        if stream_flag:
+            stream.wfile.write(chunk)
+        else:
+            parts.append(chunk)
+    return status, b"".join(parts).decode("utf-8")
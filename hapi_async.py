@@ -0,0 +1,243 @@
+""" hapi_async.py, asyncio front end for the HAPI Python Server
+
+ Part of the HAPI Python Server.  The code and documentation resides at:
+    https://github.com/hapi-server/server-python
+
+ Selected with server_mode = 'async' in <MISSION>_config.py.
+
+ One event loop owns every client socket, so thousands of idle or slow
+ clients cost sockets rather than threads.  Requests are still answered
+ by the normal hapi_server.MyHandler code: the cheap metadata endpoints
+ (capabilities, catalog, info, x_status) run directly on the loop, while
+ hapi/data and anything else that may block runs in a small thread pool.
+ Output from those blocking requests reaches the socket through a bounded
+ queue, so a slow client stalls its own reader instead of making the
+ server buffer the whole response.  HTTP/1.1 connections are kept open
+ between requests for up to idle_timeout seconds.
+"""
+
+import asyncio
+import concurrent.futures
+import http.client
+import io
+import socket
+import threading
+
+import hapi_parser as hp
+
+# endpoints that are safe to answer on the event loop itself
+LOOP_PATHS = ('hapi/capabilities', 'hapi/catalog', 'hapi/info',
+              'hapi/x_status')
+
+
+class QueueWriter():
+    """ File-like wfile for handlers running in the thread pool.
+
+    Writes are gathered into chunks of chunk_size bytes and handed to the
+    event loop through a bounded asyncio.Queue; when the queue is full the
+    writing thread blocks until the client has taken more data.
+    """
+    def __init__(self, loop, q, chunk_size):
+        self.loop = loop
+        self.q = q
+        self.chunk_size = chunk_size
+        self.buf = bytearray()
+        self.aborted = False
+
+    def _put(self, item):
+        asyncio.run_coroutine_threadsafe(self.q.put(item), self.loop).result()
+
+    def write(self, data):
+        if self.aborted:
+            raise BrokenPipeError("client disconnected")
+        self.buf += data
+        if len(self.buf) >= self.chunk_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buf and not self.aborted:
+            self._put(bytes(self.buf))
+            self.buf.clear()
+
+    def close(self):
+        # final flush plus end-of-response marker
+        try:
+            self.flush()
+        except BrokenPipeError:
+            pass
+        self._put(None)
+
+
+def make_request_class(handler_class):
+    """ Subclass handler_class so it runs without its own socket.
+
+    BaseHTTPRequestHandler normally reads the request from a socket in
+    __init__; here the event loop has already parsed it, and wfile is
+    whatever the caller provides.
+    """
+    class AsyncRequest(handler_class):
+        def __init__(self, requestline, headers, wfile, client_address,
+                     server):
+            self.requestline = requestline
+            (self.command, self.path,
+             self.request_version) = requestline.split()
+            self.headers = headers
+            self.wfile = wfile
+            self.rfile = None
+            self.client_address = client_address
+            self.server = server
+            # same keep-alive rules as BaseHTTPRequestHandler.parse_request
+            conntype = headers.get('Connection', '').lower()
+            if conntype == 'close':
+                self.close_connection = True
+            elif (conntype == 'keep-alive' or
+                  self.request_version >= 'HTTP/1.1'):
+                self.close_connection = False
+            else:
+                self.close_connection = True
+
+    return AsyncRequest
+
+
+class AsyncHAPIServer():
+    """ asyncio HTTP server answering HAPI requests with handler_class.
+
+    Offers the serve_forever/shutdown/server_close calls of the
+    socketserver classes so hapi_server.py can treat them the same.
+    """
+    def __init__(self, server_address, handler_class, reuse_port=False,
+                 sock=None, threads=8, queue_chunks=8, chunk_size=65536,
+                 idle_timeout=5):
+        self.request_class = make_request_class(handler_class)
+        if sock is None:
+            sock = socket.create_server(server_address,
+                                        reuse_port=reuse_port)
+        self.socket = sock
+        self.server_address = sock.getsockname()
+        self.threads = threads
+        self.queue_chunks = queue_chunks
+        self.chunk_size = chunk_size
+        self.idle_timeout = idle_timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix='hapi-async')
+        self.stats_lock = threading.Lock()
+        self.connections = 0
+        self.blocking_requests = 0
+        self.served = 0
+        self.loop = None
+        self.stop_event = None
+
+    def pool_stats(self):
+        with self.stats_lock:
+            return {'mode': 'async',
+                    'connections': self.connections,
+                    'threads': self.threads,
+                    'blocking_requests': self.blocking_requests,
+                    'served': self.served}
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    def shutdown(self):
+        # may be called from any thread (e.g. a signal handler)
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
+    def server_close(self):
+        self.executor.shutdown(wait=True)
+        self.socket.close()
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        server = await asyncio.start_server(self._handle_client,
+                                            sock=self.socket)
+        async with server:
+            await self.stop_event.wait()
+
+    async def _handle_client(self, reader, writer):
+        with self.stats_lock:
+            self.connections += 1
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b'\r\n\r\n'), self.idle_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+                        asyncio.LimitOverrunError, ConnectionError):
+                    break
+                close = await self._handle_request(head, writer)
+                if close:
+                    break
+        except ConnectionError:
+            pass  # client went away mid-response
+        finally:
+            with self.stats_lock:
+                self.connections -= 1
+            writer.close()
+
+    async def _handle_request(self, head, writer):
+        # answer one request, return True if the connection should close
+        (requestline, _, rest) = head.partition(b'\r\n')
+        requestline = str(requestline, 'iso-8859-1').rstrip('\r\n')
+        words = requestline.split()
+        if len(words) != 3 or words[0] not in ('GET', 'HEAD'):
+            writer.write(b'HTTP/1.0 501 Not Implemented\r\n'
+                         b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+            await writer.drain()
+            return True
+        headers = http.client.parse_headers(io.BytesIO(rest))
+        client = writer.get_extra_info('peername')
+
+        path = hp.clean_hapi_path(words[1])
+        if words[0] == 'HEAD' or path == '' or path.endswith(LOOP_PATHS):
+            wfile = io.BytesIO()
+            req = self.request_class(requestline, headers, wfile, client,
+                                     self)
+            if words[0] == 'HEAD':
+                req.do_HEAD()
+            else:
+                req.do_GET()
+            writer.write(wfile.getvalue())
+            await writer.drain()
+        else:
+            req = await self._run_blocking(requestline, headers, client,
+                                           writer)
+        with self.stats_lock:
+            self.served += 1
+        return req.close_connection
+
+    async def _run_blocking(self, requestline, headers, client, writer):
+        # run the handler in the thread pool, streaming through a queue
+        q = asyncio.Queue(maxsize=self.queue_chunks)
+        wfile = QueueWriter(self.loop, q, self.chunk_size)
+        req = self.request_class(requestline, headers, wfile, client, self)
+
+        def work():
+            with self.stats_lock:
+                self.blocking_requests += 1
+            try:
+                req.do_GET()
+            finally:
+                with self.stats_lock:
+                    self.blocking_requests -= 1
+                wfile.close()
+
+        done = self.loop.run_in_executor(self.executor, work)
+        try:
+            while True:
+                chunk = await q.get()
+                if chunk is None:
+                    break
+                writer.write(chunk)
+                await writer.drain()
+        except ConnectionError:
+            # stop the handler and empty the queue so it is not stuck
+            wfile.aborted = True
+            while (await q.get()) is not None:
+                pass
+            raise
+        finally:
+            await done
+        return req
@@ -0,0 +1,384 @@
+""" hapi_binning.py, time binning of data responses as they stream out
+
+ Part of the HAPI Python Server.  The code and documentation resides at:
+    https://github.com/hapi-server/server-python
+
+ When the config file sets downsample_bins, every dataset accepts
+
+     x_customRequestOptions.bin=PT1H          (one of downsample_bins)
+     x_customRequestOptions.binmethod=mean    (mean, minmax, first, last
+                                               or count; mean by default)
+
+ and the server bins whatever the mission's reader produces before it
+ reaches the client, so remote readers (SuperMAG, Madrigal) get it too.
+ Bins start at time.min, and each is sent as one record stamped with its
+ start; 'minmax' sends two, the minimum at the start and the maximum
+ half a bin later, to draw an envelope.  Values equal to the
+ parameter's fill (from the info) and NaN are left out; a bin with
+ nothing else gets the fill.  'count' gives the number of values left,
+ 'first' and 'last' the value as the reader wrote it.  Integers are
+ rounded, columns that are not numbers keep their first value.  The
+ response header gives the bin as the cadence.
+
+ Binning runs on blocks of records at a time with numpy (all records of
+ a block split in one call, every bin reduced with ufunc.reduceat).
+ The last, maybe unfinished, bin of a block is held back as running
+ figures (count, sum, min, max, first and last value) that the next
+ block adds to, so a bin wider than many blocks costs no more than its
+ records.  Without numpy the options are not offered.
+"""
+
+import math
+import re
+
+import hapi_sidecar
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+METHODS = ('mean', 'minmax', 'first', 'last', 'count')
+
+DURATION = re.compile(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$')
+
+
+def duration_seconds(text):
+    """ Seconds in an ISO 8601 duration of days, hours, minutes and
+    seconds (e.g. 'PT10M', 'P1D'); ValueError for anything else. """
+    found = DURATION.match(text)
+    if found is None or not any(found.groups()):
+        raise ValueError("unsupported duration %r" % text)
+    (d, h, m, s) = [int(g or 0) for g in found.groups()]
+    seconds = ((d * 24 + h) * 60 + m) * 60 + s
+    if seconds <= 0:
+        raise ValueError("zero duration %r" % text)
+    return seconds
+
+
+def parse_options(options):
+    """ {name: value} of the validated x_customRequestOptions of a
+    request (hapi_parser.handle_customRequestOptions' 'name=value'). """
+    return dict(opt.split('=', 1) for opt in options if '=' in opt)
+
+
+def column_fills(info):
+    """ Fill value (as a float, or None) of each CSV column of a dataset,
+    and its text as sent (bytes, b'NaN' without one). """
+    fills = []
+    for item in info['parameters']:
+        ncols = math.prod(item['size']) if item.get('size') else 1
+        fill = item.get('fill')
+        try:
+            value = float(fill)
+        except (TypeError, ValueError):
+            value = None
+        text = b'NaN' if value is None else str(fill).encode('utf-8')
+        fills.extend([(value, text)] * ncols)
+    return fills
+
+
+def epoch(text):
+    # seconds since 1970 of a YYYY-MM-DDTHH:MM:SS time
+    return int(numpy.datetime64(text, 's').astype('int64'))
+
+
+def time_text(seconds):
+    # YYYY-MM-DDTHH:MM:SS of seconds since 1970
+    return str(numpy.datetime64(int(seconds), 's'))
+
+
+def request_options(bins):
+    """ x_customRequestOptions entries for binning into one of bins. """
+    return [{'name': 'bin',
+             'description': 'send one record per bin of this width',
+             'constraint': {'enum': list(bins)}},
+            {'name': 'binmethod',
+             'description': 'how the records of a bin are combined',
+             'constraint': {'enum': list(METHODS)}}]
+
+
+def bin_starts(times, origin, width):
+    """ (bins, starts) of a time column (CSV field bytes, in order): the
+    bin, of width seconds from origin (seconds since 1970), of each row,
+    and the row each bin starts at. """
+    secs = times.astype('S19').astype('datetime64[s]').astype('int64')
+    bins = (secs - origin) // width
+    starts = numpy.flatnonzero(numpy.r_[True, bins[1:] != bins[:-1]])
+    return (bins, starts)
+
+
+def stamps(seconds):
+    # CSV time fields of seconds since 1970
+    text = numpy.datetime_as_string(seconds.astype('datetime64[s]'),
+                                    unit='s')
+    return numpy.char.add(text.astype('S'), b'Z')
+
+
+def partials(col, dtype, fill, starts):
+    """ Running figures of each bin of col, the rows of a column (CSV
+    field bytes) whose bins start at rows starts: a dict of arrays, one
+    entry per bin, that merge() can combine and finish() turns into text.
+
+    'count' is the number of values (of rows, for dtype 'S'), 'first'
+    and 'last' their text; numbers also get 'sum', 'min' and 'max' of
+    the values.  Values equal to the fill or NaN do not count.  dtype is
+    as from hapi_sidecar.column_dtypes ('S' for no number), fill the
+    (value, text) from column_fills.  Raises ValueError if a field of a
+    number column is not a number.
+    """
+    ends = numpy.r_[starts[1:], len(col)]
+    if dtype == 'S':
+        return {'count': ends - starts, 'first': col[starts],
+                'last': col[ends - 1]}
+    values = col.astype('float64')
+    missing = numpy.isnan(values)
+    if fill[0] is not None:
+        missing |= values == fill[0]
+    rows = numpy.arange(len(col))
+    first = numpy.minimum.reduceat(numpy.where(missing, len(col), rows),
+                                   starts)
+    last = numpy.maximum.reduceat(numpy.where(missing, -1, rows), starts)
+    present = numpy.where(missing, numpy.nan, values)
+    with numpy.errstate(invalid='ignore'):
+        return {'count': numpy.add.reduceat(~missing, starts),
+                'sum': numpy.add.reduceat(numpy.where(missing, 0.0, values),
+                                          starts),
+                'min': numpy.fmin.reduceat(present, starts),
+                'max': numpy.fmax.reduceat(present, starts),
+                'first': col[numpy.clip(first, 0, len(col) - 1)],
+                'last': col[numpy.clip(last, 0, len(col) - 1)]}
+
+
+def merge(early, late):
+    """ partials() of one bin, from those of its rows in early and in
+    late (one-bin partials of the same column, late's rows after). """
+    out = {'count': early['count'] + late['count'],
+           'first': early['first'] if early['count'][0] else late['first'],
+           'last': late['last'] if late['count'][0] else early['last']}
+    if 'sum' in early:
+        out['sum'] = early['sum'] + late['sum']
+        with numpy.errstate(invalid='ignore'):
+            out['min'] = numpy.fmin(early['min'], late['min'])
+            out['max'] = numpy.fmax(early['max'], late['max'])
+    return out
+
+
+def finish(figures, dtype, fill, method):
+    """ One field per bin of partials() figures: method one of mean, min,
+    max, first, last and count. """
+    count = figures['count']
+    if method == 'count':
+        return numpy.char.mod(b'%d', count)
+    if dtype == 'S':
+        return figures['last' if method == 'last' else 'first']
+    empty = count == 0
+    if method in ('first', 'last'):
+        return fill_empty(figures[method], empty, fill[1])
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        if method == 'mean':
+            found = figures['sum'] / count
+        else:
+            found = figures[method]
+    found = numpy.where(empty, 0, found)
+    if dtype == 'int64':
+        text = numpy.char.mod(b'%d', numpy.rint(found).astype('int64'))
+    else:
+        text = numpy.char.mod(b'%.9g', found)
+    return fill_empty(text, empty, fill[1])
+
+
+def reduce_column(col, dtype, fill, starts, method):
+    """ One field per bin of col, the rows of a column (CSV field bytes)
+    whose bins start at rows starts.
+
+    dtype is as from hapi_sidecar.column_dtypes ('S' for no number),
+    fill the (value, text) from column_fills, method one of
+    mean, min, max, first, last and count.
+    """
+    return finish(partials(col, dtype, fill, starts), dtype, fill, method)
+
+
+def fill_empty(text, empty, filltext):
+    # text, with filltext in the bins that had no values
+    text = text.astype('S%d' % max(text.itemsize, len(filltext)))
+    text[empty] = filltext
+    return text
+
+
+def split_columns(data):
+    """ One array of field bytes per CSV column of data (whole lines, each
+    ending in LF); ValueError if the lines have different numbers of
+    fields. """
+    nlines = data.count(b'\n')
+    ncols = data.count(b',', 0, data.index(b'\n')) + 1
+    if not hapi_sidecar.even_lines(data, ncols):
+        raise ValueError("lines do not all have %d fields" % ncols)
+    fields = data.replace(b'\n', b',').split(b',')
+    return [numpy.array(fields[li:nlines * ncols:ncols])
+            for li in range(ncols)]
+
+
+def join_rows(columns):
+    # CSV records of columns of field bytes
+    width = 2 * len(columns)
+    n = len(columns[0])
+    out = [b','] * (width * n)
+    for (j, col) in enumerate(columns):
+        out[2 * j::width] = col.tolist()
+    out[width - 1::width] = [b'\n'] * n
+    return b''.join(out)
+
+
+class Plan():
+    """ What a data request asks of the binning stage: a bin (and its
+    width in seconds) and a method. """
+    def __init__(self, resolution, width, method):
+        self.resolution = resolution
+        self.width = width
+        self.method = method
+
+    def header(self):
+        # info keys the response header gets in place of the dataset's
+        return {'cadence': self.resolution, 'x_binmethod': self.method}
+
+
+def plan(options):
+    """ The Plan of a request's validated custom options, or None when it
+    asks for no binning (or numpy is missing). """
+    if numpy is None:
+        return None
+    opts = parse_options(options)
+    if 'bin' not in opts:
+        return None
+    try:
+        width = duration_seconds(opts['bin'])
+    except ValueError:
+        return None
+    method = opts.get('binmethod', METHODS[0])
+    if method not in METHODS:
+        method = METHODS[0]
+    return Plan(opts['bin'], width, method)
+
+
+class Binner():
+    """ Bins a stream of CSV record blocks, see the module notes.
+
+    feed(block) returns the records of the bins finished so far (bytes,
+    maybe empty), finish() those of the rest.  dtypes and fills describe
+    the columns (as from hapi_sidecar.column_dtypes and column_fills);
+    None, or a stream with another number of columns, means numbers are
+    told from text by trying on the first block.  Raises ValueError for
+    records it cannot bin (uneven lines, bad times, a number column with
+    text further on).
+
+    The bin still open at the end of a block is kept as its partials()
+    figures, not as text, so a bin spanning many blocks costs no more
+    than its records.
+    """
+    def __init__(self, plan, timemin, dtypes=None, fills=None):
+        self.width = plan.width
+        self.method = plan.method
+        self.origin = epoch(timemin[0:19])
+        self.dtypes = dtypes
+        self.fills = fills
+        self.carry = b''      # unfinished last line
+        self.types = None     # (dtype, fill) of each column but time
+        self.open = None      # (bin, partials of each column) still open
+
+    def feed(self, block):
+        data = self.carry + block
+        cut = data.rfind(b'\n') + 1
+        (data, self.carry) = (data[:cut], data[cut:])
+        if not data:
+            return b''
+        return self.add(data, False)
+
+    def finish(self):
+        data = self.carry
+        self.carry = b''
+        if data.strip():
+            if not data.endswith(b'\n'):
+                data += b'\n'
+            return self.add(data, True)
+        if self.open is None:
+            return b''
+        (bin, figures) = self.open
+        self.open = None
+        return self.records(numpy.array([bin]), figures)
+
+    def add(self, data, last):
+        # records of the bins data (whole lines) finishes; the last bin
+        # stays open unless last
+        columns = split_columns(data)
+        if self.types is None:
+            self.types = self.column_types(columns)
+        if len(columns) != len(self.types) + 1:
+            raise ValueError("lines do not all have %d fields"
+                             % (len(self.types) + 1))
+        (bins, starts) = bin_starts(columns[0], self.origin, self.width)
+        bins = bins[starts]
+        figures = [partials(col, dtype, fill, starts)
+                   for (col, (dtype, fill)) in zip(columns[1:], self.types)]
+        out = []
+        if self.open is not None:
+            (bin, early) = self.open
+            if bin == bins[0]:
+                # the open bin goes on in this block
+                figures = [join(merge(e, take(f, slice(0, 1))),
+                                take(f, slice(1, None)))
+                           for (e, f) in zip(early, figures)]
+            else:
+                out.append(self.records(numpy.array([bin]), early))
+        if last:
+            self.open = None
+            out.append(self.records(bins, figures))
+        else:
+            self.open = (bins[-1], [take(f, slice(-1, None))
+                                    for f in figures])
+            if len(bins) > 1:
+                out.append(self.records(bins[:-1], [take(f, slice(0, -1))
+                                                    for f in figures]))
+        return b''.join(out)
+
+    def column_types(self, columns):
+        # (dtype, fill) of each column but time: from the info when it
+        # describes these columns, else float64; either way text when the
+        # first block's fields are not numbers
+        if self.dtypes is not None and len(self.dtypes) == len(columns):
+            types = list(zip(self.dtypes[1:], self.fills[1:]))
+        else:
+            types = [('float64', (None, b'NaN'))] * (len(columns) - 1)
+        for (li, col) in enumerate(columns[1:]):
+            if types[li][0] != 'S':
+                try:
+                    col.astype('float64')
+                except ValueError:
+                    types[li] = ('S', types[li][1])
+        return types
+
+    def records(self, bins, figures):
+        # CSV records of the bins (numbers from origin) with figures
+        seconds = self.origin + bins * self.width
+        if self.method == 'minmax':
+            # a min record, then a max record, for every bin
+            (low, high) = [
+                [stamps(seconds + offset)] +
+                [finish(f, dtype, fill, method)
+                 for (f, (dtype, fill)) in zip(figures, self.types)]
+                for (method, offset) in (('min', 0), ('max', self.width // 2))]
+            return join_rows([numpy.stack([a, b], axis=1).ravel()
+                              for (a, b) in zip(low, high)])
+        return join_rows([stamps(seconds)] + [
+            finish(f, dtype, fill, self.method)
+            for (f, (dtype, fill)) in zip(figures, self.types)])
+
+
+def take(figures, rows):
+    # partials() of the bins rows (a slice)
+    return {key: values[rows] for (key, values) in figures.items()}
+
+
+def join(head, rest):
+    # partials() of the bins of head, then of rest
+    return {key: numpy.concatenate([head[key], rest[key]]) for key in head}
@@ -0,0 +1,388 @@
+""" hapi_cache.py, response cache for hapi/data
+
+ Part of the HAPI Python Server.  The code and documentation resides at:
+    https://github.com/hapi-server/server-python
+
+ Dashboards poll the same window and notebooks re-run the same cell, so
+ identical data requests are common.  DataCache keeps finished data
+ bodies (uncompressed, without the optional header) in memory, least
+ recently used first out, within a byte budget.  Entries pushed out of
+ memory can spill to files in cache_dir, themselves held to a budget.
+
+ Entries expire after ttl seconds, or ttl_recent seconds when the
+ requested range reaches into the last hour (data may still be arriving).
+ SIGHUP clears the cache along with the metadata.
+
+ Identical requests arriving while the first is still being answered
+ (a workshop class all running the same cell) do not start readers of
+ their own: Flights lets them replay the first request's output as it
+ is written, so the reader, and any upstream call, runs once.
+"""
+
+import collections
+import hashlib
+import os
+import threading
+import time
+
+import hapi_output
+from hapi_time import epoch_seconds
+
+# ranges ending later than this many seconds ago may still get new data
+RECENT = 3600
+
+# suffix of spilled entries in cache_dir
+SUFFIX = '.hapicache'
+
+
+def data_key(mission, id, timemin, timemax, parameters, options, format):
+    """ Cache key for a data request, from its normalized pieces. """
+    if parameters is not None:
+        parameters = tuple(parameters)
+    if options:
+        # the 'name=value' list from hapi_parser.handle_customRequestOptions
+        options = tuple(sorted(str(opt) for opt in options))
+    else:
+        options = ()
+    return (mission, id, timemin, timemax, parameters, options, format)
+
+
+def is_recent(timemax):
+    try:
+        stop = epoch_seconds(timemax)
+    except (ValueError, OverflowError):
+        return True
+    return stop > time.time() - RECENT
+
+
+class CaptureWriter():
+    """ wfile wrapper keeping a copy of what is written, up to limit bytes.
+
+    Past the limit the copy is dropped (too big to cache) while writes
+    keep going through to raw.
+    """
+    def __init__(self, raw, limit):
+        self.raw = raw
+        self.limit = limit
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        if self.parts is not None:
+            self.size += len(data)
+            if self.size > self.limit:
+                self.parts = None
+            else:
+                self.parts.append(bytes(data))
+        return self.raw.write(data)
+
+    def sendfile(self, f, offset, count, encoding=None):
+        # a file range is copied while it fits; past the limit there is
+        # no copy to keep, so it can reach raw by os.sendfile
+        if self.parts is not None and self.size + count <= self.limit:
+            hapi_output.write_range(self, f, offset, count, encoding)
+            return
+        self.parts = None
+        hapi_output.send_file(self.raw, f, offset, count, encoding)
+
+    def flush(self):
+        self.raw.flush()
+
+    def getvalue(self):
+        # captured bytes, or None if they went over the limit
+        if self.parts is None:
+            return None
+        return b''.join(self.parts)
+
+
+class Flight(CaptureWriter):
+    """ wfile wrapper of a request that others are waiting on.
+
+    Everything written is kept for followers to replay, and for the
+    cache.  Once more than limit bytes are written no new followers can
+    join, and the copy is dropped when the current ones are done.  If the
+    leading client goes away, the reader keeps going for the followers.
+    """
+    def __init__(self, raw, limit):
+        CaptureWriter.__init__(self, raw, limit)
+        self.cond = threading.Condition()
+        self.followers = 0
+        self.joinable = True
+        self.orphaned = False
+        self.done = False
+        self.status = None
+
+    def write(self, data):
+        with self.cond:
+            if self.parts is not None:
+                self.parts.append(bytes(data))
+                self.size += len(data)
+                if self.size > self.limit:
+                    self.joinable = False
+                    if self.followers == 0:
+                        self.parts = None
+                self.cond.notify_all()
+            if self.orphaned:
+                if self.followers == 0:
+                    raise BrokenPipeError("client disconnected")
+                return len(data)
+        try:
+            return self.raw.write(data)
+        except OSError:
+            with self.cond:
+                if self.followers == 0:
+                    raise
+                self.orphaned = True
+            return len(data)
+
+    def sendfile(self, f, offset, count, encoding=None):
+        # followers replay copies, so a file range only goes straight to
+        # the leader's client once nobody can use a copy any more
+        with self.cond:
+            direct = self.parts is None and not self.orphaned
+        if direct:
+            hapi_output.send_file(self.raw, f, offset, count, encoding)
+        else:
+            hapi_output.write_range(self, f, offset, count, encoding)
+
+    def getvalue(self):
+        with self.cond:
+            if self.parts is None or self.size > self.limit:
+                return None
+            return b''.join(self.parts)
+
+    def finish(self, status):
+        with self.cond:
+            (self.done, self.status) = (True, status)
+            self.cond.notify_all()
+
+    def replay(self, wfile):
+        """ Copy the leader's output to wfile as it arrives; returns its
+        HAPI status. """
+        sent = 0
+        try:
+            while True:
+                with self.cond:
+                    while sent == len(self.parts) and not self.done:
+                        self.cond.wait()
+                    chunks = self.parts[sent:]
+                    done = self.done
+                for chunk in chunks:
+                    wfile.write(chunk)
+                sent += len(chunks)
+                if done and not chunks:
+                    return self.status
+        finally:
+            with self.cond:
+                self.followers -= 1
+                if self.followers == 0 and not self.joinable:
+                    self.parts = None
+
+
+class Flights():
+    """ Data requests being answered right now, by cache key. """
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.led = 0
+        self.coalesced = 0
+
+    def stats(self):
+        with self.lock:
+            return {'in_flight': len(self.flights),
+                    'led': self.led,
+                    'coalesced': self.coalesced}
+
+    def join(self, key, wfile):
+        """ (flight, True) if the caller should run the reader writing to
+        flight, (flight, False) if it should flight.replay() instead, or
+        (None, False) to run on its own (the running one is too large).
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = Flight(wfile, self.limit)
+                self.flights[key] = flight
+                self.led += 1
+                return (flight, True)
+            with flight.cond:
+                if not flight.joinable:
+                    return (None, False)
+                flight.followers += 1
+            self.coalesced += 1
+            return (flight, False)
+
+    def land(self, key, flight, status):
+        # the leader is done; later requests start a new flight (or hit
+        # the cache, which is filled before this)
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+        flight.finish(status)
+
+
+class DataCache():
+    """ Byte-bounded LRU cache of data bodies, with optional disk spillover.
+    """
+    def __init__(self, max_bytes, entry_max_bytes, ttl, ttl_recent,
+                 cache_dir=None, disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.entry_max_bytes = min(entry_max_bytes, max_bytes)
+        self.ttl = ttl
+        self.ttl_recent = ttl_recent
+        self.cache_dir = cache_dir if disk_max_bytes > 0 else None
+        self.disk_max_bytes = disk_max_bytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # key: (expires, body)
+        self.size = 0
+        self.disk = collections.OrderedDict()    # file name: size
+        self.disk_size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.purge_disk()
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries),
+                    'bytes': self.size,
+                    'max_bytes': self.max_bytes,
+                    'disk_entries': len(self.disk),
+                    'disk_bytes': self.disk_size,
+                    'hits': self.hits,
+                    'disk_hits': self.disk_hits,
+                    'misses': self.misses,
+                    'stores': self.stores,
+                    'evictions': self.evictions}
+
+    def capture(self, wfile):
+        return CaptureWriter(wfile, self.entry_max_bytes)
+
+    def get(self, key):
+        """ Cached body for key, or None. """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                self._drop(key)
+        body = self._read_disk(key, now)
+        with self.lock:
+            if body is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        return body
+
+    def put(self, key, body, timemax):
+        """ Store body for a request whose range ends at timemax. """
+        if body is None or len(body) > self.entry_max_bytes:
+            return
+        ttl = self.ttl_recent if is_recent(timemax) else self.ttl
+        if ttl <= 0:
+            return
+        spill = []
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (time.time() + ttl, body)
+            self.size += len(body)
+            self.stores += 1
+            while self.size > self.max_bytes:
+                (oldkey, old) = self.entries.popitem(last=False)
+                self.size -= len(old[1])
+                self.evictions += 1
+                spill.append((oldkey, old))
+        # disk writes happen outside the lock
+        for (oldkey, old) in spill:
+            self._write_disk(oldkey, old)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+        if self.cache_dir is not None:
+            self.purge_disk(everything=True)
+
+    def _drop(self, key):
+        # with self.lock held
+        (expires, body) = self.entries.pop(key)
+        self.size -= len(body)
+
+    # disk spillover: one file per entry, its mtime set to its expiry time,
+    # so worker processes sharing cache_dir can all use it
+
+    def _disk_name(self, key):
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + SUFFIX
+
+    def _write_disk(self, key, entry):
+        if self.cache_dir is None or entry[0] <= time.time():
+            return
+        (expires, body) = entry
+        name = self._disk_name(key)
+        path = os.path.join(self.cache_dir, name)
+        tmp = path + '.%d.tmp' % os.getpid()
+        try:
+            with open(tmp, 'wb') as fout:
+                fout.write(body)
+            os.utime(tmp, (expires, expires))
+            os.replace(tmp, path)
+        except OSError:
+            return # disk full or the like: just do without
+        removals = []
+        with self.lock:
+            if name in self.disk:
+                self.disk_size -= self.disk.pop(name)
+            self.disk[name] = len(body)
+            self.disk_size += len(body)
+            while self.disk_size > self.disk_max_bytes:
+                (oldname, oldsize) = self.disk.popitem(last=False)
+                self.disk_size -= oldsize
+                removals.append(oldname)
+        for oldname in removals:
+            self._remove(oldname)
+
+    def _read_disk(self, key, now):
+        if self.cache_dir is None:
+            return None
+        name = self._disk_name(key)
+        path = os.path.join(self.cache_dir, name)
+        try:
+            if os.stat(path).st_mtime <= now:
+                self._remove(name)
+                return None
+            with open(path, 'rb') as fin:
+                return fin.read()
+        except OSError:
+            return None
+
+    def _remove(self, name):
+        try:
+            os.remove(os.path.join(self.cache_dir, name))
+        except OSError:
+            pass
+
+    def purge_disk(self, everything=False):
+        # drop expired (or all) spilled entries, e.g. left by a past run
+        now = time.time()
+        with self.lock:
+            self.disk.clear()
+            self.disk_size = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(SUFFIX):
+                continue
+            try:
+                expired = os.stat(os.path.join(self.cache_dir,
+                                               name)).st_mtime <= now
+            except OSError:
+                continue
+            if everything or expired:
+                self._remove(name)
@@ -0,0 +1,375 @@
+""" hapi_fileindex.py, in-memory index of data files
+
+ Part of the HAPI Python Server.  The code and documentation resides at:
+    https://github.com/hapi-server/server-python
+
+ File-based datasets keep their records in files laid out by a template,
+ relative to <dir>/data/[id]/.  The default is one file per day,
+     $Y/<id>.$Y$m$d.csv
+ and a config file can set file_template (for all datasets) or
+ file_templates (per id) to others, e.g. monthly '$Y/<id>_$Y$m.csv',
+ hourly '$Y/$j/<id>.$Y$j$H.csv' or a single file '<id>.csv'.  Templates
+ are paths with '/' between directories and these fields:
+     $Y year, $m month, $d day of month, $j day of year, $H hour,
+     <id> the dataset id
+ The finest field gives the time each file covers (an hour, day, month,
+ year, or everything when there is none).  Files may also be compressed,
+ as .gz, .zst or .bz2 after the name; a plain file wins if a time has
+ both.
+
+ Listing those directories on every request (for the reader and for
+ Last-Modified) costs milliseconds per directory on network filesystems,
+ so each dataset's files are indexed once, sorted by start time, with
+ their size and mtime.  A time range is then mapped to exactly the files
+ it overlaps by binary search, and Last-Modified is answered from memory.
+
+ An index is refreshed at most every check_interval seconds: directories
+ whose mtime changed are listed again, and the newest file (the one that
+ may still be growing) is stat()ed again.  Older files rewritten in
+ place are only noticed after reload(), which hapi_server.py calls on
+ SIGHUP.
+
+ The first and last timestamps of a file are read (from its first and
+ last lines) the first time someone asks for them, then kept.  For a
+ compressed file that means decoding it once.
+"""
+
+import bisect
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+import hapi_output
+
+# bytes read from the end of a file to find its last record
+TAIL_BYTES = 4096
+
+# the day-file layout data files have unless a config file says otherwise
+DEFAULT_TEMPLATE = '$Y/<id>.$Y$m$d.csv'
+
+# template fields, and the digits they match
+FIELDS = {'Y': 4, 'm': 2, 'd': 2, 'j': 3, 'H': 2}
+
+# endings of compressed files, and their encoding
+COMPRESSED = {'.gz': 'gzip', '.zst': 'zstd', '.bz2': 'bzip2'}
+
+# start and stop times (as in lookup()) of a file covering everything
+ALL_TIME = ('0000-01-01T00:00:00', '9999-12-31T23:59:59')
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+class Template():
+    """ File layout of one dataset: which paths, relative to its data
+    directory, are data files, and the time each covers.
+
+    Raises ValueError for a template with time fields but no $Y.
+    """
+    def __init__(self, template, id):
+        fields = set(re.findall(r'\$([YmdjH])', template))
+        if fields and 'Y' not in fields:
+            raise ValueError("file template %r has no $Y" % template)
+        self.template = template
+        parts = template.split('/')
+        # each directory level on its own, to walk only matching ones
+        self.dirs = [re.compile(pattern(part, id, False) + '$')
+                     for part in parts[:-1]]
+        self.path = re.compile(pattern(template, id, True) +
+                               r'(?P<ext>\.gz|\.zst|\.bz2)?$')
+        if 'H' in fields:
+            self.granule = 'hour'
+        elif 'd' in fields or 'j' in fields:
+            self.granule = 'day'
+        elif 'm' in fields:
+            self.granule = 'month'
+        elif 'Y' in fields:
+            self.granule = 'year'
+        else:
+            self.granule = None
+
+    def match(self, relpath):
+        """ (start, stop, encoding) of the file at relpath ('/' between
+        directories), or None if it is not a data file. """
+        found = self.path.match(relpath)
+        if found is None:
+            return None
+        encoding = COMPRESSED.get(found.group('ext'))
+        if self.granule is None:
+            return ALL_TIME + (encoding,)
+        fields = found.groupdict()
+        try:
+            if fields.get('j'):
+                year = datetime(int(fields['Y']), 1, 1)
+                days = (year.replace(year=year.year + 1) - year).days
+                if not 1 <= int(fields['j']) <= days:
+                    return None  # no such day in that year
+                start = year + timedelta(days=int(fields['j']) - 1)
+            else:
+                start = datetime(int(fields['Y']), int(fields.get('m') or 1),
+                                 int(fields.get('d') or 1))
+            start = start.replace(hour=int(fields.get('H') or 0))
+        except (TypeError, ValueError):
+            return None  # not a real date
+        if self.granule == 'hour':
+            stop = start + timedelta(hours=1)
+        elif self.granule == 'day':
+            stop = start + timedelta(days=1)
+        elif self.granule == 'month':
+            (y, m) = divmod(start.month, 12)
+            stop = start.replace(year=start.year + y, month=m + 1)
+        else:
+            stop = start.replace(year=start.year + 1)
+        return (start.strftime(TIME_FORMAT), stop.strftime(TIME_FORMAT),
+                encoding)
+
+
+def pattern(text, id, named):
+    # regular expression for a template (or one directory level of it);
+    # named: fields become named groups, repeats must match the first
+    out = []
+    seen = set()
+    for piece in re.split(r'(\$[YmdjH]|<id>)', text):
+        if piece == '<id>':
+            out.append(re.escape(id))
+        elif len(piece) == 2 and piece[0] == '$' and piece[1] in FIELDS:
+            field = piece[1]
+            digits = r'\d{%d}' % FIELDS[field]
+            if not named:
+                out.append(digits)
+            elif field in seen:
+                out.append('(?P=%s)' % field)
+            else:
+                out.append('(?P<%s>%s)' % (field, digits))
+                seen.add(field)
+        else:
+            out.append(re.escape(piece))
+    return ''.join(out)
+
+
+class DataFile():
+    """ One data file: path, start and stop of the time it covers
+    (YYYY-MM-DDTHH:MM:SS), encoding (None for plain CSV), size and
+    mtime. """
+    __slots__ = ('path', 'start', 'stop', 'encoding', 'size', 'mtime',
+                 '_bounds')
+
+    def __init__(self, path, start, stop, st, encoding=None):
+        self.path = path
+        self.start = start
+        self.stop = stop
+        self.encoding = encoding
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self._bounds = None
+
+    def bounds(self):
+        """ (first, last) leading timestamps of the file's records, or
+        (None, None) if it holds none. """
+        return self._read_bounds()[0:2]
+
+    def plain(self):
+        """ True if every line of the file ends in LF alone, so its
+        records can be sent as they are. """
+        return self._read_bounds()[2]
+
+    def _read_bounds(self):
+        if self._bounds is None:
+            self._bounds = read_bounds(self.path, self.size, self.encoding)
+        return self._bounds
+
+
+def read_bounds(path, size, encoding=None):
+    first = last = None
+    try:
+        with open(path, 'rb') as raw:
+            if encoding is None:
+                head = raw.readline()
+                raw.seek(max(0, size - TAIL_BYTES))
+                tail = raw.read()
+            else:
+                with hapi_output.open_decoded(raw, encoding) as fin:
+                    head = fin.readline()
+                    tail = head
+                    while True:
+                        data = fin.read(hapi_output.SLICE_SIZE)
+                        if not data:
+                            break
+                        tail = tail[-TAIL_BYTES:] + data
+    except (OSError, EOFError):
+        return (None, None, False)
+    plain = (head.endswith(b'\n') and not head.endswith(b'\r\n') and
+             tail.endswith(b'\n'))
+    tail = tail.rstrip(b'\r\n')
+    if head.strip():
+        first = str(head.split(b',', 1)[0], 'utf-8').strip()
+        last = str(tail.rsplit(b'\n', 1)[-1].split(b',', 1)[0],
+                   'utf-8').strip()
+    return (first, last, plain)
+
+
+class DatasetFiles():
+    """ Data files of one dataset directory, sorted by start time. """
+    def __init__(self, datadir, template):
+        self.datadir = datadir
+        self.template = template
+        self.lock = threading.Lock()
+        # directory: (mtime, subdirectories or, at the last level, files)
+        self.dirs = {}
+        self.files = ([], [])  # (sorted start times, DataFile for each)
+        self.checked = 0
+
+    def refresh(self, interval=0):
+        # re-list changed directories, re-stat the newest file,
+        # unless another thread did so in the last interval seconds
+        with self.lock:
+            if self.checked and time.time() - self.checked < interval:
+                return
+            dirs = {}
+            files = []
+            self.walk(self.datadir, 0, dirs, files)
+            # a plain file sorts before its compressed copies, and is kept
+            files.sort(key=lambda f: (f.start, f.encoding is not None,
+                                      f.path))
+            files = [f for (i, f) in enumerate(files)
+                     if i == 0 or f.start != files[i - 1].start]
+            if files:
+                newest = files[-1]
+                try:
+                    st = os.stat(newest.path)
+                    if (st.st_size != newest.size or
+                            st.st_mtime != newest.mtime):
+                        files[-1] = DataFile(newest.path, newest.start,
+                                             newest.stop, st,
+                                             newest.encoding)
+                        listed = dirs[os.path.dirname(newest.path)][1]
+                        listed[listed.index(newest)] = files[-1]
+                except OSError:
+                    files.pop()
+            self.dirs = dirs
+            # one assignment, so lookups see one version or the other
+            self.files = ([f.start for f in files], files)
+            self.checked = time.time()
+
+    def walk(self, path, level, dirs, files):
+        # add the data files under directory path, which is at template
+        # directory level, to files; listings of unchanged directories
+        # are taken from self.dirs
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return
+        old = self.dirs.get(path)
+        if old is not None and old[0] == mtime:
+            dirs[path] = old
+        elif level < len(self.template.dirs):
+            dirs[path] = (mtime, list_dirs(path, self.template.dirs[level]))
+        else:
+            dirs[path] = (mtime, list_files(path, self.datadir,
+                                            self.template))
+        if level < len(self.template.dirs):
+            for sub in dirs[path][1]:
+                self.walk(sub, level + 1, dirs, files)
+        else:
+            files.extend(dirs[path][1])
+
+    def lookup(self, timemin, timemax):
+        """ Data files covering any of [timemin, timemax)
+        (YYYY-MM-DDTHH:MM:SS). """
+        (starts, files) = self.files
+        lo = max(0, bisect.bisect_right(starts, timemin) - 1)
+        hi = bisect.bisect_left(starts, timemax)
+        if lo < hi and files[lo].stop <= timemin:
+            lo += 1
+        return files[lo:hi]
+
+    def last_modified(self, timemin, timemax):
+        """ Newest mtime of the data files in range, or None. """
+        files = self.lookup(timemin, timemax)
+        if not files:
+            return None
+        return max(f.mtime for f in files)
+
+
+def list_dirs(path, regex):
+    # subdirectories of path whose names match regex
+    dirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if regex.match(entry.name) and entry.is_dir():
+                dirs.append(entry.path)
+    return sorted(dirs)
+
+
+def list_files(path, datadir, template):
+    # data files of the last directory level of a template
+    files = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            relpath = os.path.relpath(entry.path, datadir)
+            found = template.match(relpath.replace(os.sep, '/'))
+            if found is None:
+                continue
+            (start, stop, encoding) = found
+            try:
+                files.append(DataFile(entry.path, start, stop,
+                                      entry.stat(), encoding))
+            except OSError:
+                continue
+    return files
+
+
+class FileIndex():
+    """ DatasetFiles for every dataset directory asked about.
+
+    The layout of a dataset [id] is templates[id], or template.
+    """
+    def __init__(self, check_interval=10, template=DEFAULT_TEMPLATE):
+        # seconds between refreshes, negative = only on reload()
+        self.check_interval = check_interval
+        self.template = template
+        self.templates = {}
+        self.lock = threading.Lock()
+        self.datasets = {}  # normalized dataset directory: DatasetFiles
+
+    def load_all(self, datadirs):
+        # build the indexes up front (e.g. before pre-forking workers)
+        for datadir in datadirs:
+            self.dataset(datadir)
+        return len(self.datasets)
+
+    def reload(self):
+        # forget everything; directories are listed again on next use
+        with self.lock:
+            self.datasets = {}
+
+    def dataset(self, datadir):
+        """ Up to date (within check_interval) DatasetFiles for datadir.
+
+        Only existing directories are kept in the index; for anything
+        else (no data yet, or an id climbing out with '..') an empty
+        DatasetFiles is returned and forgotten.
+        """
+        if '..' in datadir.replace('\\', '/').split('/'):
+            return DatasetFiles(datadir, None)
+        datadir = os.path.normpath(datadir)
+        entry = self.datasets.get(datadir)
+        if entry is None:
+            if not os.path.isdir(datadir):
+                return DatasetFiles(datadir, None)
+            id = os.path.basename(datadir)
+            template = Template(self.templates.get(id, self.template), id)
+            with self.lock:
+                entry = self.datasets.setdefault(
+                    datadir, DatasetFiles(datadir, template))
+        if entry.checked == 0:
+            entry.refresh()
+        elif (self.check_interval >= 0 and
+                time.time() - entry.checked >= self.check_interval):
+            entry.refresh(self.check_interval)
+        return entry
+
+
+# shared by the readers and hapi_parser.get_last_modified
+INDEX = FileIndex()
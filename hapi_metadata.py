@@ -0,0 +1,275 @@
+""" hapi_metadata.py, in-memory registry of the HAPI metadata files
+
+ Part of the HAPI Python Server.  The code and documentation resides at:
+    https://github.com/hapi-server/server-python
+
+ capabilities.json, catalog.json and info/<id>.json are read once and
+ kept both parsed and as ready-to-send bytes.  A file is re-read only
+ when its mtime or size changes (checked at most every check_interval
+ seconds) or after reload(), which hapi_server.py calls on SIGHUP.
+
+ info responses may hold the "now", "lastday" and "lasthour" macros
+ (see hapi_parser.do_info_macros).  Only the lines holding them are
+ re-expanded, and only when the value they expand to has changed.
+
+ Every response also has an ETag, a hash of its (uncompressed) content,
+ computed when the file is read or the macros re-expanded.
+
+ Data requests get a DatasetMeta: the parsed info file plus the
+ parameter names and CSV column layout, built once per file version and
+ shared read-only by validation, header writing and the reader.
+"""
+
+import collections.abc
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+
+import hapi_parser as hp
+
+# info macros, and how often what they expand to changes
+MACROS_BY_SECOND = ('"now"',)
+MACROS_BY_DAY = ('"lastday-P1D"', '"lastday"', '"lasthour"')
+
+# parameter subsets remembered per info file
+MAX_VARIANTS = 64
+
+
+class MetaFile():
+    """ One metadata file: raw bytes, parsed JSON and stat details. """
+    def __init__(self, path, st):
+        self.path = path
+        self.mtime = st.st_mtime
+        self.size = st.st_size
+        self.checked = time.time()
+        with open(path, 'rb') as fin:
+            self.raw = fin.read()
+        self.etag = content_tag(self.raw)
+        try:
+            self.parsed = json.loads(self.raw)
+        except ValueError:
+            self.parsed = None
+        self.variants = {}  # rendered info responses, see info()
+        self.dataset = None # DatasetMeta, built on first data request
+
+
+class DatasetMeta(collections.abc.Mapping):
+    """ Read-only info/<id>.json for data requests.
+
+    Reads like the dict from hapi_parser.fetch_info_params (so readers
+    can keep using catalog['parameters']), and also carries:
+      names   parameter names, in info order
+      columns CSV column indices of each parameter (arrays span several)
+      xopts   the x_customRequestOptions the dataset allows
+    """
+    def __init__(self, id, info):
+        self.id = id
+        self._info = dict(info)
+        # 'limitduration' is an optional HAPI keyword, units=sec
+        self._info.setdefault('limitduration', 0) # 0 = no limit enforced
+        self.names = [item['name'] for item in info['parameters']]
+        self.columns = {}
+        col = 0
+        for item in info['parameters']:
+            ncols = math.prod(item['size']) if item.get('size') else 1
+            self.columns[item['name']] = list(range(col, col + ncols))
+            col += ncols
+        self.ncolumns = col
+        self.xopts = info.get('x_customRequestOptions', [])
+
+    def __getitem__(self, key):
+        if key == 'stopDate':
+            # HAPI's in-house 'lasthour' as a proper date
+            return hp.lasthour_mod(self._info[key])
+        return self._info[key]
+
+    def __iter__(self):
+        return iter(self._info)
+
+    def __len__(self):
+        return len(self._info)
+
+    def parameters_map(self, parameters):
+        """ Same result as csv_hapireader.do_parameters_map, without
+        re-reading the info file: {parameter index: [CSV columns]} for the
+        requested parameters, in info order, Time (index 0) always first.
+        """
+        param_dict = {0: [0]}
+        for (idx, name) in enumerate(self.names):
+            if name in parameters:
+                param_dict[idx] = self.columns[name]
+        return param_dict
+
+
+class InfoVariant():
+    """ An info response for one (parameters, prefix) combination.
+
+    lines holds the response as do_write_info would write it, macros
+    unexpanded; macro_lines are the indices of lines holding a macro.
+    """
+    def __init__(self, lines, prefix):
+        self.lines = lines
+        self.prefix = '' if prefix is None else prefix
+        self.macro_lines = [i for (i, l) in enumerate(lines)
+                            if any(m in l for m in
+                                   MACROS_BY_SECOND + MACROS_BY_DAY)]
+        self.by_second = any(m in lines[i] for i in self.macro_lines
+                             for m in MACROS_BY_SECOND)
+        self.stamp = None
+        self.body = None
+        self.etag = None
+        if not self.macro_lines:
+            self.body = self.join(lines)
+            self.etag = content_tag(self.body)
+
+    def join(self, lines):
+        return bytes(''.join(self.prefix + l + '\n' for l in lines), "utf-8")
+
+    def render(self):
+        if not self.macro_lines:
+            return self.body
+        # macros change every second ("now") or at midnight (the rest)
+        if self.by_second:
+            stamp = int(time.time())
+        else:
+            stamp = time.strftime('%Y%m%d')
+        if stamp != self.stamp:
+            lines = list(self.lines)
+            for i in self.macro_lines:
+                lines[i] = hp.do_info_macros(lines[i])
+            body = self.join(lines)
+            (self.stamp, self.body, self.etag) = (stamp, body,
+                                                  content_tag(body))
+        return self.body
+
+
+class MetadataRegistry():
+    """ Serves capabilities, catalog and info responses from memory. """
+    def __init__(self, hapi_home, check_interval=2):
+        self.hapi_home = hapi_home
+        # seconds between mtime checks, negative = only on reload()
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.files = {}  # path relative to hapi_home: MetaFile
+
+    def load_all(self):
+        # warm up with everything the catalog points to
+        self.get('capabilities.json')
+        catalog = self.get('catalog.json')
+        if catalog is not None and catalog.parsed is not None:
+            for ele in catalog.parsed.get('catalog', []):
+                self.get(info_path(ele['id']))
+        return len(self.files)
+
+    def reload(self):
+        # forget everything; files are re-read on next use
+        with self.lock:
+            self.files = {}
+
+    def get(self, relpath):
+        """ Return the MetaFile for relpath, or None if it does not exist. """
+        entry = self.files.get(relpath)
+        if entry is not None and (
+                self.check_interval < 0 or
+                time.time() - entry.checked < self.check_interval):
+            return entry
+        with self.lock:
+            path = os.path.join(self.hapi_home, relpath)
+            try:
+                st = os.stat(path)
+            except OSError:
+                self.files.pop(relpath, None)
+                return None
+            entry = self.files.get(relpath)
+            if (entry is None or entry.mtime != st.st_mtime or
+                    entry.size != st.st_size):
+                entry = MetaFile(path, st)
+                self.files[relpath] = entry
+            else:
+                entry.checked = time.time()
+        return entry
+
+    def capabilities(self):
+        return self.capabilities_entity()[0]
+
+    def catalog(self):
+        return self.catalog_entity()[0]
+
+    def capabilities_entity(self):
+        """ (body, etag) of capabilities.json, from the same read. """
+        entry = self.get('capabilities.json')
+        return (entry.raw, entry.etag)
+
+    def catalog_entity(self):
+        """ (body, etag) of catalog.json, from the same read. """
+        entry = self.get('catalog.json')
+        return (entry.raw, entry.etag)
+
+    def has_info(self, id):
+        return self.get(info_path(id)) is not None
+
+    def dataset(self, id):
+        """ DatasetMeta for id, or None if it has no (valid) info file. """
+        entry = self.get(info_path(id))
+        if entry is None or entry.parsed is None:
+            return None
+        if entry.dataset is None:
+            try:
+                entry.dataset = DatasetMeta(id, entry.parsed)
+            except (KeyError, TypeError):
+                return None # no usable 'parameters' list
+        return entry.dataset
+
+    def info(self, id, parameters, prefix, overrides=None):
+        """ Bytes of hapi_parser.do_write_info(id, parameters, ..., prefix).
+
+        overrides: info keys to replace (e.g. the cadence of aggregated
+        data, see hapi_pyramid.Plan.header), or None.
+        """
+        return self.info_entity(id, parameters, prefix, overrides)[0]
+
+    def info_entity(self, id, parameters, prefix, overrides=None):
+        """ (body, etag) of an info response, see info(). """
+        entry = self.get(info_path(id))
+        if entry is None or entry.parsed is None:
+            body = bytes(hp.do_write_info(id, parameters, self.hapi_home,
+                                          prefix), "utf-8")
+            return (body, content_tag(body))
+        key = (None if parameters is None else tuple(parameters), prefix,
+               None if overrides is None else tuple(sorted(overrides.items())))
+        variant = entry.variants.get(key)
+        if variant is None:
+            info = entry.parsed
+            if overrides:
+                info = dict(info, **overrides)
+            variant = InfoVariant(info_lines(info, parameters), prefix)
+            if len(entry.variants) >= MAX_VARIANTS:
+                entry.variants.clear()
+            entry.variants[key] = variant
+        body = variant.render()
+        return (body, variant.etag)
+
+
+def content_tag(data):
+    # strong validator: same bytes, same tag, in every worker process
+    return hashlib.blake2b(data, digest_size=12).hexdigest()
+
+
+def info_path(id):
+    return 'info/' + id + '.json'
+
+
+def info_lines(infoJsonModel, parameters):
+    # same layout as hapi_parser.do_write_info, before macros and prefix
+    if parameters is not None:
+        allParameters = infoJsonModel['parameters']
+        includeParams = set(parameters)
+        infoJsonModel = dict(infoJsonModel)
+        infoJsonModel['parameters'] = [
+            p for (i, p) in enumerate(allParameters)
+            if i == 0 or p['name'] in includeParams]
+    infoJson = json.dumps(infoJsonModel, indent=4, separators=(',', ': '))
+    return infoJson.split('\n')
@@ -0,0 +1,334 @@
+""" hapi_output.py, response body writers for the HAPI Python Server
+
+ Part of the HAPI Python Server.  The code and documentation resides at:
+    https://github.com/hapi-server/server-python
+
+ File-like objects that sit between the code producing a response body
+ (MyHandler, or a reader writing to stream.wfile) and the client socket.
+ Each one offers write/flush/close and passes its output on to the raw
+ writer it wraps.  Streamed bodies pass through a BufferedWriter first,
+ so readers producing many small pieces cost few socket writes.
+
+ Writers that pass bytes on unchanged also offer sendfile(f, offset,
+ count, encoding), so a reader's file ranges (hapi_reader.FileRange)
+ reach a plain socket through os.sendfile without being read into
+ Python; send_file() falls back to writing mmap slices wherever that
+ chain is broken (by compression, a response cache copy or a buffered
+ body).  A range of a gzip or zstd file is decoded, or with
+ compressed_passthrough in the config file passed on as it is when the
+ response is compressed the same way.
+
+ zstd compression (and reading .zst files) needs the optional
+ 'zstandard' package; without it only gzip is offered.
+"""
+
+import bz2
+import gzip
+import io
+import mmap
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Content-Encoding values this module can produce
+ENCODINGS = ('gzip', 'zstd')
+
+# send_file writes mapped files in slices of this many bytes
+SLICE_SIZE = 1 << 20
+
+
+def send_file(writer, f, offset, count, encoding=None):
+    """ Write count bytes of the open binary file f, from offset, to writer.
+
+    With an encoding ('gzip', 'zstd' or 'bzip2') the range is a whole
+    file in that coding, and what it decodes to is written.  Uses
+    writer.sendfile() when it has one, else write_range().
+    """
+    if count <= 0:
+        return
+    sendfile = getattr(writer, 'sendfile', None)
+    if sendfile is not None:
+        sendfile(f, offset, count, encoding)
+    else:
+        write_range(writer, f, offset, count, encoding)
+
+
+def write_range(writer, f, offset, count, encoding=None):
+    """ send_file() through writer.write(): mmap slices, or decoded. """
+    if encoding is None:
+        write_file(writer, f, offset, count)
+    else:
+        write_decoded(writer, f, offset, count, encoding)
+
+
+def open_decoded(raw, encoding):
+    """ File-like reading what the binary file raw decodes to, when it
+    holds the encoding 'gzip', 'zstd' or 'bzip2' (None = raw as it is).
+    """
+    if encoding is None:
+        return raw
+    if encoding == 'gzip':
+        return gzip.GzipFile(fileobj=raw, mode='rb')
+    if encoding == 'bzip2':
+        return bz2.BZ2File(raw)
+    if zstandard is None:
+        raise OSError("reading zstd files needs the 'zstandard' package")
+    # buffered, so readline() works on it too
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+        raw, read_across_frames=True, closefd=False))
+
+
+def write_decoded(writer, f, offset, count, encoding):
+    """ Write what count bytes of f from offset, in encoding, decode to. """
+    f.seek(offset)
+    with open_decoded(io.BufferedReader(Slice(f, count)), encoding) as dec:
+        while True:
+            data = dec.read(SLICE_SIZE)
+            if not data:
+                break
+            writer.write(data)
+
+
+class Slice(io.RawIOBase):
+    """ Reads at most count bytes of the binary file f from where it is. """
+    def __init__(self, f, count):
+        self.f = f
+        self.left = count
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        data = self.f.read(min(len(buf), self.left))
+        self.left -= len(data)
+        buf[:len(data)] = data
+        return len(data)
+
+
+def write_file(writer, f, offset, count):
+    """ Write count bytes of the open binary file f, from offset, to
+    writer.write() as slices of the file mapped into memory. """
+    if count <= 0:
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with memoryview(mapped) as view:
+            end = offset + count
+            while offset < end:
+                part = min(end - offset, SLICE_SIZE)
+                with view[offset:offset + part] as piece:
+                    writer.write(piece)
+                offset += part
+
+
+class SocketWriter(io.BufferedIOBase):
+    """ Unbuffered writer to a connected socket, like the wfile socketserver
+    gives request handlers, plus sendfile() for file ranges.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.sock.sendall(data)
+        with memoryview(data) as view:
+            return view.nbytes
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def sendfile(self, f, offset, count, encoding=None):
+        # os.sendfile where the socket allows it (not over TLS)
+        if encoding is not None:
+            write_decoded(self, f, offset, count, encoding)
+        else:
+            self.sock.sendfile(f, offset, count)
+
+
+class BufferedWriter():
+    """ Gathers small writes into one reusable buffer of size bytes.
+
+    The buffer is passed on when it fills up, on flush(), or on the first
+    write more than interval seconds after the last time it was passed on
+    (so a slow reader's output still reaches the client; 0 = only when
+    full).  Writes of at least size bytes into an empty buffer go straight
+    through.  Raw writers must copy what they keep, as the buffer is
+    reused.
+    """
+    def __init__(self, raw, size, interval=0):
+        self.raw = raw
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.used = 0
+        self.interval = interval
+        self.last = time.monotonic()
+
+    def write(self, data):
+        size = len(self.buf)
+        n = len(data)
+        if self.used == 0 and n >= size:
+            self.raw.write(data)
+            self.last = time.monotonic()
+            return n
+        start = 0
+        while start < n:
+            part = min(n - start, size - self.used)
+            self.buf[self.used:self.used + part] = data[start:start + part]
+            self.used += part
+            start += part
+            if self.used == size:
+                self._send()
+        if ( self.interval > 0 and
+             time.monotonic() - self.last >= self.interval ):
+            self.flush()
+        return n
+
+    def _send(self):
+        if self.used:
+            self.raw.write(self.view[:self.used])
+            self.used = 0
+        self.last = time.monotonic()
+
+    def flush(self):
+        self._send()
+        self.raw.flush()
+
+    def sendfile(self, f, offset, count, encoding=None):
+        # what is buffered goes first, then the file range past the buffer
+        self._send()
+        send_file(self.raw, f, offset, count, encoding)
+        self.last = time.monotonic()
+
+    def close(self):
+        # passes on what is left but does not close the raw writer
+        self._send()
+
+
+class ChunkedWriter():
+    """ Frames every write as one HTTP/1.1 chunk.
+
+    close() sends the zero-length last chunk but leaves the connection
+    open, so the client can send its next request on it.
+    """
+    def __init__(self, raw):
+        self.raw = raw
+
+    def write(self, data):
+        if data:
+            self.raw.write(b''.join((b'%X\r\n' % len(data), data, b'\r\n')))
+        return len(data)
+
+    def sendfile(self, f, offset, count, encoding=None):
+        # one chunk holding the file range
+        if encoding is not None:
+            write_decoded(self, f, offset, count, encoding)
+        elif count > 0:
+            self.raw.write(b'%X\r\n' % count)
+            send_file(self.raw, f, offset, count)
+            self.raw.write(b'\r\n')
+
+    def flush(self):
+        self.raw.flush()
+
+    def close(self):
+        self.raw.write(b'0\r\n\r\n')
+        self.raw.flush()
+
+
+def choose_encoding(accept_encoding, allowed):
+    """ Negotiate a Content-Encoding from a request's Accept-Encoding.
+
+    allowed is the mission's list of encodings in order of preference;
+    returns the first one the client accepts, or None for identity.
+    """
+    accepted = {}
+    for item in accept_encoding.split(','):
+        (name, _, params) = item.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name.strip().lower()] = q
+    for enc in allowed:
+        if enc not in ENCODINGS or (enc == 'zstd' and zstandard is None):
+            continue
+        if accepted.get(enc, accepted.get('*', 0.0)) > 0:
+            return enc
+    return None
+
+
+def make_compressor(encoding, level):
+    # incremental compressor with compress()/flush() for the encoding
+    if encoding == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zstandard.ZstdCompressor(level=level).compressobj()
+
+
+def compress(data, encoding, level):
+    # one-shot compression of a complete (buffered) body
+    comp = make_compressor(encoding, level)
+    return comp.compress(data) + comp.flush()
+
+
+class CompressWriter():
+    """ Compresses a streamed body as it is written.
+
+    Every write goes through one gzip or zstd compression stream, so the
+    per-file writes of the streaming readers are compressed incrementally;
+    compressed bytes reach the raw writer whenever the compressor has
+    a block ready; flush() pushes out everything written so far.  close()
+    ends the stream but not the raw writer.
+
+    With passthrough, a file already compressed the same way goes out
+    as it is, between gzip members (or zstd frames) of its own.  The body
+    is then several members in a row, which HTTP allows but some clients
+    do not decode past the first (e.g. zlib with wbits=31); without it
+    every file is decoded and compressed again into one stream.
+    """
+    def __init__(self, raw, encoding, level, passthrough=False):
+        self.raw = raw
+        self.encoding = encoding
+        self.level = level
+        self.passthrough = passthrough
+        self.comp = make_compressor(encoding, level)
+        self.started = False  # anything given to comp since it was made
+
+    def write(self, data):
+        if data:
+            self.started = True
+        out = self.comp.compress(data)
+        if out:
+            self.raw.write(out)
+        return len(data)
+
+    def sendfile(self, f, offset, count, encoding=None):
+        if not self.passthrough or encoding != self.encoding:
+            write_range(self, f, offset, count, encoding)
+            return
+        if self.started:
+            # end the current member, the file's own members follow
+            self.raw.write(self.comp.flush())
+            self.comp = make_compressor(self.encoding, self.level)
+            self.started = False
+        send_file(self.raw, f, offset, count)
+
+    def flush(self):
+        if self.encoding == 'gzip':
+            out = self.comp.flush(zlib.Z_SYNC_FLUSH)
+        else:
+            out = self.comp.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        if out:
+            self.raw.write(out)
+        self.raw.flush()
+
+    def close(self):
+        self.raw.write(self.comp.flush())
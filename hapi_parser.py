@@ -18,10 +18,10 @@ import urllib.parse as urlparse
 import glob
 import os
 from os.path import exists
-import dateutil.parser
 from datetime import datetime, date, timedelta
 import datetime
-from dateutil.parser import parse, isoparse
+from hapi_time import parse_time, normalize_time, time_key
+import hapi_fileindex
 import json
 from email.utils import parsedate_tz,formatdate
 import importlib
@@ -45,10 +45,78 @@ class defaultvars():
     floc={}
     reader_name = "csv_hapireader"
     csv_hapireader = importlib.import_module(reader_name, package=None)
-    hapi_handler = csv_hapireader.do_data_csv
+    hapi_handler = csv_hapireader.iter_data_csv
     tags_allowed = [''] # no subparams allowed
     stream_flag = True
 
+# Optional <MISSION>_config.py settings, with the defaults used when a
+# config file does not set them.
+optional_config = {
+    'server_mode': 'threaded',  # 'threaded' = one thread per request,
+                                # 'pool' = fixed worker pool + bounded queue
+                                # 'async' = asyncio event loop (hapi_async)
+    'pool_workers': 8,          # worker threads in 'pool' mode
+    'pool_queue_size': 32,      # connections allowed to wait for a worker
+    'async_threads': 8,         # 'async' mode: threads for data requests
+    'async_queue_chunks': 8,    # 'async' mode: 64 KiB chunks buffered
+                                # per client before its reader waits
+    'keepalive_timeout': 5,     # seconds an idle HTTP/1.1 connection is kept
+    'compression': ['zstd', 'gzip'], # encodings offered, in preference order
+                                # ([] = never compress; zstd needs the
+                                # optional 'zstandard' package)
+    'compress_min_size': 1024,  # smaller buffered bodies are sent as-is
+    'gzip_level': 6,            # 1 (fast) .. 9 (small)
+    'zstd_level': 3,            # 1 (fast) .. 19 (small)
+    'compressed_passthrough': False, # send .csv.gz/.csv.zst day files to
+                                # clients as they are, see README
+    'metadata_check_interval': 2, # seconds between mtime checks of the
+                                # metadata JSON files (-1 = only on SIGHUP)
+    'metadata_max_age': 60,     # Cache-Control max-age for capabilities,
+                                # catalog and info (0 = always revalidate)
+    'cache_max_bytes': 64 << 20, # memory for cached data responses
+                                # (0 = no data cache)
+    'cache_entry_max_bytes': 8 << 20, # larger responses are not cached
+    'cache_ttl': 3600,          # seconds a cached response is reused ...
+    'cache_ttl_recent': 60,     # ... or this if it reaches the last hour
+    'cache_dir': None,          # directory for responses pushed out of
+    'cache_disk_max_bytes': 0,  # memory, up to this many bytes (0 = none)
+    'coalesce_requests': True,  # identical concurrent data requests share
+                                # one reader run
+    'write_buffer_size': 128 << 10, # streamed output is sent in blocks
+                                # of this many bytes ...
+    'write_flush_interval': 1.0, # ... or at least this often (seconds,
+                                # 0 = only when a block is full)
+    'file_index_interval': 10,  # seconds between rescans of the data
+                                # file index (-1 = only on SIGHUP)
+    'file_template': '$Y/<id>.$Y$m$d.csv', # layout of the data files
+                                # under data/[id]/ (see hapi_fileindex)
+    'file_templates': {},       # per dataset id, overriding file_template
+    'read_ahead_files': 2,      # data files a reader may read ahead of
+                                # the one being sent (0 = none) ...
+    'read_threads': 4,          # ... on this many threads, shared by all
+                                # requests (0 = no read-ahead)
+    'sidecar_dir': None,        # directory for column copies of
+                                # CSV day files (None = none; needs numpy)
+    'sidecar_interval': 300,    # seconds between passes of their converter
+    'pyramid_dir': None,        # directory for aggregates at coarser
+                                # cadences (None = none; needs numpy)
+    'pyramid_levels': ['PT1M', 'PT10M', 'PT1H', 'P1D'], # cadences kept,
+                                # for datasets whose info offers them
+    'pyramid_interval': 300,    # seconds between passes of their builder
+    'downsample_bins': [],      # bin widths any data request may ask for
+                                # (x_customRequestOptions.bin, e.g.
+                                # ['PT1M', 'PT1H']; [] = none; needs numpy)
+    'workers': 1,               # server processes (--workers N overrides)
+    'drain_timeout': 30,        # seconds workers get to finish on shutdown
+    }
+
+def set_optional_config(CFG):
+    # fill in any optional settings the config file did not provide
+    for key in optional_config:
+        if not hasattr(CFG, key):
+            setattr(CFG, key, optional_config[key])
+    return CFG
+
 def fetchdata(hapi_handler, id, timemin, timemax, parameters, mydata,
               floc, stream_flag, s):
     (status, data) = hapi_hander(id, timemin, timemax, parameters, mydata, floc, stream_flag, s)
@@ -91,7 +159,7 @@ def parse_config(myname):
         # as per Jeremy's original code
         import csv_hapireader
         CFG=defaultvars()        
-    return CFG
+    return set_optional_config(CFG)
 
 ##if CFG.api_datatype == 'aws':
 ##    import s3netcdf
@@ -185,15 +253,20 @@ def csv_removekeys(magdata):
 
 ### HAPI required error and support utilities
 
-def generic_check_error(id, timemin, timemax, parameters, hapihome):
+def generic_check_error(id, timemin, timemax, parameters, hapihome,
+                        meta=None):
     # TESTED
     # does check of generic HAPI parameters
     # note we already checked that time.min (1402),time.max (1403) are 
     # valid prior to this and also that id is valid (1406)
+    # meta: the request's hapi_metadata.DatasetMeta, if already loaded
 
     timemax = lasthour_mod(timemax)
     errorcode = 0 # assume all is well
-    (stat,mydata)=fetch_info_params(id,hapihome,False)
+    if meta is not None:
+        (stat,mydata)=(True,meta)
+    else:
+        (stat,mydata)=fetch_info_params(id,hapihome,False)
     if stat == False:
         errorcode = 1406
         # no valid json exists so 'Bad request - unknown dataset id'
@@ -202,27 +275,19 @@ def generic_check_error(id, timemin, timemax, parameters, hapihome):
     else:
         #print("debug: for id ",id," got ",mydata)
         limit_duration=mydata['limitduration']
-        archive_startdate=parse(mydata['startDate'],ignoretz=True)
+        archive_startdate=parse_time(mydata['startDate'])
         # yet more datehandling, for now/lastday/lasthour/etc
         stopdate=mydata['stopDate']
         if 'now' in stopdate or 'last' in stopdate:
             archive_stopdate=datetime.datetime.now()
         else:
-            archive_stopdate=parse(stopdate,ignoretz=True)
-        # Handling below to even allow YYYY-DOYTHH:MMZ times via isoparse
-        try:
-            ptimemin=parse(timemin,ignoretz=True)
-        except:
-            #print("using isotime for timemin",timemin)
-            ptimemin=isoparse(timemin).replace(tzinfo=None)
-        try:
-            ptimemax=parse(timemax,ignoretz=True)
-        except:
-            #print("using isotime for timemax",timemax)
-            ptimemax=isoparse(timemax).replace(tzinfo=None)
+            archive_stopdate=parse_time(stopdate)
+        # parse_time also allows YYYY-DOYTHH:MMZ times (see hapi_time.py)
+        ptimemin=parse_time(timemin)
+        ptimemax=parse_time(timemax)
         # Reformat so they are cleaner and return to main
-        qtimemin= ptimemin.strftime('%Y-%m-%dT%H:%MZ')
-        qtimemax= ptimemax.strftime('%Y-%m-%dT%H:%MZ')
+        qtimemin= normalize_time(timemin)
+        qtimemax= normalize_time(timemax)
         if ptimemin >= ptimemax:
             errorcode = 1404  # 'time.min equal to or after time.max'
         elif ptimemin < archive_startdate or ptimemax > archive_stopdate:
@@ -263,32 +328,19 @@ def do_write_info(id, parameters, hapi_home, prefix ):
 def get_last_modified( id, hapi_home, timemin, timemax ):
     # TESTED
     '''return the time stamp of the most recently modified file,
-    from files in $Y/$(x,name=id).$Y$m$d.csv, seconds since epoch (1970) UTC'''
+    from the data files laid out as hapi_fileindex says (by default
+    $Y/<id>.$Y$m$d.csv), seconds since epoch (1970) UTC'''
     ff= hapi_home + 'data/' + id + '/'
     #print("debug: checking last modified in ",ff,timemin)
-    try:
-        filemin= dateutil.parser.parse( timemin ).strftime('%Y%m%d')
-        filemax= dateutil.parser.parse( timemax ).strftime('%Y%m%d')
-        timemin= dateutil.parser.parse( timemin ).strftime('%Y-%m-%dT%H:%M:%S')
-        timemax= dateutil.parser.parse( timemax ).strftime('%Y-%m-%dT%H:%M:%S')
-        yrmin= int( timemin[0:4] )
-        yrmax= int( timemax[0:4] )
-    except:
-        # time parsing problem, move on
-        yrmin = 1
-        yrmax = 0 # these two force loop to not happen
     lastModified= None
-    ##from email.utils import formatdate
-    for yr in range(yrmin,yrmax+1):
-        ffyr= ff + '%04d' % yr
-        if ( not os.path.exists(ffyr) ): continue
-        files= sorted( os.listdir( ffyr ) ) 
-        for file in files:
-             ymd= file[-12:-4]
-             if ( filemin<=ymd and ymd<=filemax ):
-                  mtime= os.path.getmtime( ffyr + '/' + file )
-                  if ( lastModified==None or mtime>lastModified ):
-                      lastModified=mtime
+    try:
+        filemin= parse_time( timemin ).strftime('%Y-%m-%dT%H:%M:%S')
+        filemax= parse_time( timemax ).strftime('%Y-%m-%dT%H:%M:%S')
+        # answered from the in-memory file index, see hapi_fileindex.py
+        lastModified= hapi_fileindex.INDEX.dataset(ff).last_modified(
+            filemin, filemax)
+    except (ValueError, OverflowError):
+        pass # time parsing problem, move on
     # if no files use current time
     if lastModified == None:
         lastModified = time.time()
@@ -479,32 +531,70 @@ def check_v2_v3(query):
         query['time.max']=query['stop']
     return(query)
 
+class TimeWindow():
+    """ Trims time-ordered CSV records (bytes) to [timemin, timemax).
+
+    Records are located by binary search on their leading timestamp, so
+    only a few dozen of them are parsed per buffer however long it is.
+    Feed it a response's buffers in order; once one starts at or after
+    timemax, past_end is set and the rest can be skipped.
+    """
+    def __init__(self, timemin, timemax):
+        self.keymin = time_key(timemin)
+        self.keymax = time_key(timemax)
+        self.past_end = False
+
+    def _key(self, buf, start):
+        # time of the record starting at offset start
+        end = buf.find(b'\n', start)
+        if end < 0:
+            end = len(buf)
+        comma = buf.find(b',', start, end)
+        if comma >= 0:
+            end = comma
+        return time_key(str(buf[start:end], 'utf-8'))
+
+    def _first_from(self, buf, key):
+        # offset of the first record in buf at or after key (or len(buf))
+        (lo, hi) = (0, len(buf))
+        while lo < hi:
+            mid = (lo + hi) // 2
+            nl = buf.rfind(b'\n', lo, mid)
+            start = lo if nl < 0 else nl + 1
+            if self._key(buf, start) >= key:
+                hi = start
+            else:
+                nl = buf.find(b'\n', start)
+                lo = len(buf) if nl < 0 else nl + 1
+        return lo
+
+    def trim(self, buf):
+        """ the part of buf inside the window """
+        if not buf or self.past_end:
+            return b''
+        last = buf.rfind(b'\n', 0, len(buf.rstrip(b'\r\n'))) + 1
+        if self._key(buf, 0) >= self.keymin:
+            if self._key(buf, last) < self.keymax:
+                return buf
+            start = 0
+        elif self._key(buf, last) < self.keymin:
+            return b''
+        else:
+            start = self._first_from(buf, self.keymin)
+        end = self._first_from(buf, self.keymax)
+        if end == 0:
+            self.past_end = True
+        return buf[start:end]
+
 def truncate_data(timemin, timemax, data):
     # for data that is larger than given window, truncate it
-    checkstart = True
-    datalines = data.split('/n')
-    truestart = 0
-    trueend = len(datalines)
-    for i in range(len(datalines)):
-        timestamp = datalines[i].split(',')[0]
-        if checkstart:
-            if compare_time(timestamp, timemin) == 'before':
-                truestart = i
-            else:
-                checkstart = False
-        if compare_time(timestamp, timemax) == 'after':
-            trueend = i
-            break
-    if truestart == 0 and trueend == len(datelines):
-        return data
-    else:
-        return '\n'.join(data[truestart:trueend])
+    return str(TimeWindow(timemin, timemax).trim(bytes(data, 'utf-8')),
+               'utf-8')
 
 def compare_times(t1: str, t2: str) -> str:
-    # as per clean_query_time, compares formats of %Y-%m-%dT%H:%MZ
-    fmt = "%Y-%m-%dT%H:%MZ"
-    dt1 = datetime.datetime.strptime(t1, fmt)
-    dt2 = datetime.datetime.strptime(t2, fmt)
+    # compares any two ISO 8601 times, to the microsecond
+    dt1 = time_key(t1)
+    dt2 = time_key(t2)
     if dt1 < dt2:
         return "before"
     elif dt1 > dt2:
@@ -517,18 +607,16 @@ def clean_query_time(query):
     errorcode = 0 # assume all is well
     timemin= query['time.min'][0]
     timemax= lasthour_mod(query['time.max'][0])
-    # right now our parser can only handle format %Y-%m-%dT%H:%MZ
-    # so truncatee entries with seconds.milliseconds
-    timemin=timemin[0:16]+'Z'
-    timemax=timemax[0:16]+'Z'
+    # keep the full precision asked for (seconds, fractions, YYYY-DOY)
+    # but in one form that readers and trimming all understand
     # error-checking here
     try:
-        parse(timemin)
-    except:
+        timemin=normalize_time(timemin)
+    except (ValueError, OverflowError):
         errorcode= 1402   # error in time.min
     try:
-        parse(timemax)
-    except:
+        timemax=normalize_time(timemax)
+    except (ValueError, OverflowError):
         errorcode = 1403   # error in time.max
     #print("Debug: lasthour check:",timemax)    
     return(timemin, timemax, errorcode)
@@ -548,15 +636,20 @@ def get_lastModified(api_datatype, id, hapi_home, timemin, timemax):
         lastModified=time.time()
     return(lastModified)
 
-def prep_data(query, hapihome, tags):
+def prep_data(query, hapihome, tags, meta=None):
     # TESTED
+    # meta: the request's hapi_metadata.DatasetMeta, so info/[id].json
+    # is parsed once per request (or not at all) instead of per check
     id= query['id'][0]
     (timemin, timemax, errorcode) = clean_query_time(query)
     parameters= handle_key_parameters(query)
     (check_error,timemin,timemax) = generic_check_error(
-        id,timemin,timemax,parameters,hapihome)
+        id,timemin,timemax,parameters,hapihome,meta)
     # Two passes here-- first, that no non-HAPI params exist
-    (stat,mydata)=fetch_info_params(id,hapihome,False)
+    if meta is not None:
+        mydata=meta
+    else:
+        (stat,mydata)=fetch_info_params(id,hapihome,False)
     allparams = [ item['name'] for item in mydata['parameters'] ]
     if parameters != None:
         if 'Time' not in allparams:
@@ -0,0 +1,265 @@
+""" hapi_pyramid.py, coarser cadences of CSV datasets, aggregated ahead
+
+ Part of the HAPI Python Server.  The code and documentation resides at:
+    https://github.com/hapi-server/server-python
+
+ Plotting clients often ask for months of one-minute records to draw a
+ thousand pixels.  A dataset whose info offers the request option
+
+     "x_customRequestOptions": [
+         {"name": "resolution",
+          "constraint": {"enum": ["PT10M", "PT1H", "P1D"]}},
+         {"name": "aggregation",
+          "constraint": {"enum": ["mean", "min", "max"]}}]
+
+ can be asked for x_customRequestOptions.resolution=PT1H (and
+ optionally .aggregation=min or max; mean otherwise).  The response
+ has the dataset's columns, one record per bin of that width (aligned
+ to midnight UTC, stamped with the bin's start), and its header gives
+ the resolution as the cadence.
+
+ Without more configuration the bins are aggregated from the data files
+ while the request waits.  When the config file sets pyramid_dir, a
+ background thread keeps the min, max and mean of every bin, for each
+ of pyramid_levels the dataset offers, as numpy .npz files under
+     <pyramid_dir>/[id]/<resolution>/YYYY/[id].YYYYMMDDTHHMMSS.npz
+ one per data file (or per bin, when data files are shorter than a bin).
+ Requests read those; pieces not built yet, or whose data files changed
+ since, are aggregated from the data files as without them.
+ As for hapi_sidecar, files changed in the last check_interval seconds
+ are left for a later pass, and with several worker processes the one
+ holding a lock file in pyramid_dir does the building.
+
+ Bins skip fill values (from the info) and NaN; a bin with nothing
+ else gets the fill value.  Integers are rounded, non-numeric columns
+ keep the first value of each bin.  Bin widths should divide the time
+ a data file covers, so no bin spans two of them.
+
+ Needs numpy; without it the option is ignored (the server says so when
+ it starts) and records are sent at their own cadence.
+"""
+
+import json
+import os
+import time
+
+import hapi_binning
+import hapi_output
+import hapi_sidecar
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# aggregations kept for every bin, the first is the default
+AGGREGATIONS = ('mean', 'min', 'max')
+
+
+def offered_resolutions(xopts):
+    """ Resolutions a dataset's x_customRequestOptions (from its info)
+    let requests ask for. """
+    for opt in xopts:
+        if opt.get('name') == 'resolution':
+            return opt.get('constraint', {}).get('enum', [])
+    return []
+
+
+def aggregate(columns, dtypes, fills, width):
+    """ The mean, min and max of each bin of width seconds of the rows of
+    columns (as from hapi_sidecar.parse_columns, times in order).
+
+    Returns arrays of CSV field text: 'c0' the bins' start times, and
+    'mean<n>', 'min<n>', 'max<n>' for every other column n.
+    """
+    (bins, starts) = hapi_binning.bin_starts(columns[0], 0, width)
+    arrays = {'c0': hapi_binning.stamps(bins[starts] * width)}
+    for li in range(1, len(columns)):
+        for agg in AGGREGATIONS:
+            arrays['%s%d' % (agg, li)] = hapi_binning.reduce_column(
+                columns[li], dtypes[li], fills[li], starts, agg)
+    return arrays
+
+
+def aggregate_files(files, dtypes, fills, width):
+    """ aggregate() of the records of the DataFiles files, in order;
+    raises ValueError if they do not parse into columns. """
+    parts = []
+    for datafile in files:
+        with open(datafile.path, 'rb') as raw:
+            with hapi_output.open_decoded(raw, datafile.encoding) as fin:
+                parts.append(fin.read().replace(b'\r\n', b'\n'))
+        if parts[-1] and not parts[-1].endswith(b'\n'):
+            parts[-1] += b'\n'
+    data = b''.join(parts)
+    if not data.strip():
+        return None
+    return aggregate(hapi_sidecar.parse_columns(data, dtypes), dtypes, fills,
+                     width)
+
+
+class Aggregates():
+    """ One aggregation of a pyramid piece, read like a sidecar by
+    hapi_sidecar.records(). """
+    def __init__(self, arrays, aggregation):
+        self.arrays = arrays
+        self.aggregation = aggregation
+
+    def __getitem__(self, key):
+        if key == 'c0':
+            return self.arrays['c0']
+        return self.arrays[self.aggregation + key[1:]]
+
+
+class Plan():
+    """ What a data request asks of the pyramid: a resolution (and its
+    width in seconds) and an aggregation. """
+    def __init__(self, resolution, width, aggregation):
+        self.resolution = resolution
+        self.width = width
+        self.aggregation = aggregation
+
+    def header(self):
+        # info keys the response header gets in place of the dataset's
+        return {'cadence': self.resolution,
+                'x_aggregation': self.aggregation}
+
+
+def plan(options):
+    """ The Plan of a request's validated custom options, or None when it
+    asks for no resolution (or numpy is missing). """
+    if numpy is None:
+        return None
+    opts = hapi_binning.parse_options(options)
+    if 'resolution' not in opts:
+        return None
+    try:
+        width = hapi_binning.duration_seconds(opts['resolution'])
+    except ValueError:
+        return None
+    aggregation = opts.get('aggregation', AGGREGATIONS[0])
+    if aggregation not in AGGREGATIONS:
+        aggregation = AGGREGATIONS[0]
+    return Plan(opts['resolution'], width, aggregation)
+
+
+def pieces(dataset, width, timemin, timemax):
+    """ (key, DataFiles) of the pieces of a dataset (a
+    hapi_fileindex.DatasetFiles) holding the bins of width seconds that
+    start in [timemin, timemax). """
+    lo = hapi_binning.epoch(timemin) // width * width
+    hi = -(-hapi_binning.epoch(timemax) // width) * width
+    return group_files(dataset.lookup(hapi_binning.time_text(lo),
+                                      hapi_binning.time_text(hi)), width)
+
+
+class PyramidStore(hapi_sidecar.Builder):
+    """ Aggregated pieces of the datasets in a FileIndex. """
+    lockname = '.builder.lock'
+    threadname = 'hapi-pyramid'
+
+    def __init__(self, root, infodir, levels, check_interval=300):
+        hapi_sidecar.Builder.__init__(self, root, check_interval)
+        self.infodir = infodir
+        self.levels = {}  # resolution: width in seconds
+        for level in levels:
+            self.levels[level] = hapi_binning.duration_seconds(level)
+
+    def path(self, datadir, resolution, key):
+        id = os.path.basename(os.path.normpath(datadir))
+        stamp = key.replace('-', '').replace(':', '')
+        return os.path.join(self.root, id, resolution, stamp[0:4],
+                            '%s.%s.npz' % (id, stamp))
+
+    def load(self, datadir, resolution, key, files):
+        """ The piece as an open numpy NpzFile, or None if it is not built
+        or its data files changed since. """
+        try:
+            npz = numpy.load(self.path(datadir, resolution, key))
+        except (OSError, ValueError):
+            return None
+        try:
+            source = npz['source']
+        except (KeyError, ValueError):
+            source = None
+        if source is None or not numpy.array_equal(source, signature(files)):
+            npz.close()
+            return None
+        return npz
+
+    def build(self, datadir, resolution, key, files, dtypes, fills):
+        # aggregate one piece and save it; raises ValueError if its
+        # files do not fit their info
+        arrays = aggregate_files(files, dtypes, fills,
+                                 self.levels[resolution])
+        if arrays is None:
+            raise ValueError("no records")
+        arrays['source'] = signature(files)
+        self.save(self.path(datadir, resolution, key), arrays)
+
+    def convert(self, index):
+        """ One pass: build the missing or outdated pieces of every
+        dataset in index (a hapi_fileindex.FileIndex). """
+        seen = {}  # only the pieces still there are remembered
+        for datadir in list(index.datasets):
+            id = os.path.basename(datadir)
+            try:
+                with open(os.path.join(self.infodir, id + '.json')) as fin:
+                    info = json.load(fin)
+                dtypes = hapi_sidecar.column_dtypes(info)
+                fills = hapi_binning.column_fills(info)
+            except (OSError, ValueError, KeyError):
+                continue
+            (starts, files) = index.dataset(datadir).files
+            xopts = info.get('x_customRequestOptions', [])
+            for resolution in offered_resolutions(xopts):
+                if resolution not in self.levels:
+                    continue
+                width = self.levels[resolution]
+                for (key, group) in group_files(files, width):
+                    if any(time.time() - f.mtime < self.check_interval
+                           for f in group):
+                        continue  # may still be growing
+                    path = self.path(datadir, resolution, key)
+                    source = signature(group).tobytes()
+                    if self.seen.get(path) == source:
+                        seen[path] = source
+                        continue
+                    npz = self.load(datadir, resolution, key, group)
+                    if npz is not None:
+                        npz.close()
+                    else:
+                        try:
+                            self.build(datadir, resolution, key, group,
+                                       dtypes, fills)
+                            self.built += 1
+                        except (OSError, EOFError, ValueError):
+                            self.failed += 1  # aggregated per request
+                    seen[path] = source
+        self.seen = seen
+
+
+def group_files(files, width):
+    # DataFiles (in order) in the pieces bins of width seconds are kept
+    # in: a file on its own, or all files of one bin when they are shorter
+    groups = []
+    for datafile in files:
+        start = hapi_binning.epoch(datafile.start)
+        if hapi_binning.epoch(datafile.stop) - start >= width:
+            key = datafile.start
+        else:
+            key = hapi_binning.time_text(start // width * width)
+        if groups and groups[-1][0] == key:
+            groups[-1][1].append(datafile)
+        else:
+            groups.append((key, [datafile]))
+    return groups
+
+
+def signature(files):
+    # (mtime, size) of the data files a piece is built from
+    return numpy.array([[f.mtime, f.size] for f in files], dtype='float64')
+
+
+# set by hapi_server.py when the config file has a pyramid_dir
+PYRAMIDS = None
@@ -0,0 +1,244 @@
+""" hapi_reader.py, how the HAPI Python Server runs mission readers
+
+ Part of the HAPI Python Server.  The code and documentation resides at:
+    https://github.com/hapi-server/server-python
+
+ A reader (the config file's hapi_handler) turns a data request into
+ CSV records.  The preferred form is a generator function
+
+     def my_reader(id, timemin, timemax, parameters, catalog, floc):
+         ...
+         yield b'2018-01-19T00:00:00Z,1.5\\n'   # whole records, as bytes
+         ...
+         return 1200   # HAPI status, 1201 (no data) or an error >= 1400
+
+ that yields the response body in chunks of whole records and returns
+ its HAPI status.  The server owns everything after that: buffering or
+ chunked streaming, compression, time-window trimming, error responses
+ and the socket, so a reader never holds more than one chunk and never
+ touches the handler.
+
+ A reader whose files already hold the records exactly as they are to
+ be sent may yield FileRange(f, offset, count) instead of bytes: a range
+ of an open file, of whole records all inside [timemin, timemax).  It is
+ not trimmed, and is copied to the client with os.sendfile or mmap (see
+ hapi_output.send_file) before the reader is resumed, so the reader can
+ close f afterwards.  FileRange(f, 0, size, 'gzip') stands for what a
+ whole gzip (or 'zstd', 'bzip2') file decodes to; with
+ compressed_passthrough it goes out still compressed when the response
+ is compressed the same way.
+
+ Readers working through many files can hand the per-file work to
+ PREFETCH.map(), so the next few files are read on other threads while
+ the current one is going out to the client.
+
+ Older readers, called as
+     (status, data) = reader(id, timemin, timemax, parameters, catalog,
+                             floc, stream_flag, stream)
+ which return the whole body as a str or write it to stream.wfile
+ themselves, are adapted by open_reader() so the server sees the same
+ chunks either way.
+"""
+
+import collections
+import inspect
+import io
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import hapi_output
+
+# chunks a streaming legacy reader may get ahead of the client by
+LEGACY_QUEUE_CHUNKS = 8
+
+
+class FileRange():
+    """ count bytes of the open binary file f, from offset, yielded by a
+    reader in place of the same bytes (or of what they decode to, for an
+    encoding). """
+    __slots__ = ('f', 'offset', 'count', 'encoding')
+
+    def __init__(self, f, offset, count, encoding=None):
+        self.f = f
+        self.offset = offset
+        self.count = count
+        self.encoding = encoding
+
+    def read(self):
+        out = io.BytesIO()
+        hapi_output.write_range(out, self.f, self.offset, self.count,
+                                self.encoding)
+        return out.getvalue()
+
+    def send(self, writer):
+        hapi_output.send_file(writer, self.f, self.offset, self.count,
+                              self.encoding)
+
+
+class Prefetcher():
+    """ Runs per-file reader work ahead of the reader, on a shared pool.
+
+    map(fn, items) returns fn(item) for each item in order, while up to
+    depth later items are already being worked on by the pool's threads
+    (shared by all requests).  threads or depth 0 = work in the caller.
+    """
+    def __init__(self, threads=4, depth=2):
+        self.depth = depth
+        self.pool = None
+        if threads > 0 and depth > 0:
+            self.pool = ThreadPoolExecutor(threads,
+                                           thread_name_prefix='hapi-prefetch')
+
+    def map(self, fn, items):
+        if self.pool is None or len(items) < 2:
+            for item in items:
+                yield fn(item)
+            return
+        pending = collections.deque()
+        try:
+            for item in items:
+                pending.append(self.pool.submit(fn, item))
+                if len(pending) > self.depth:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # the request ended early: drop work not started yet
+            for future in pending:
+                future.cancel()
+
+
+# shared by the readers; hapi_server.py sizes it from the config file
+PREFETCH = Prefetcher()
+
+
+class ReaderRun():
+    """ Iterable over a reader's chunks; status is set once it is used up.
+
+    Closing it (or dropping it early) closes the reader's generator too.
+    """
+    def __init__(self, gen):
+        self.gen = gen
+        self.status = None
+
+    def __iter__(self):
+        self.status = yield from self.gen
+
+    def close(self):
+        self.gen.close()
+
+
+def open_reader(handler, id, timemin, timemax, parameters, catalog, floc,
+                stream_flag, buffer_size=65536, flush_interval=0):
+    """ Start handler on a data request, whichever form it has.
+
+    buffer_size and flush_interval set how an older streaming reader's
+    writes are gathered into chunks (see hapi_output.BufferedWriter).
+    """
+    if inspect.isgeneratorfunction(handler):
+        gen = handler(id, timemin, timemax, parameters, catalog, floc)
+    elif stream_flag:
+        stream = LegacyStream(LEGACY_QUEUE_CHUNKS, buffer_size,
+                              flush_interval)
+        gen = legacy_streamed(handler, stream, id, timemin, timemax,
+                              parameters, catalog, floc)
+    else:
+        gen = legacy_buffered(handler, id, timemin, timemax, parameters,
+                              catalog, floc)
+    return ReaderRun(gen)
+
+
+def legacy_buffered(handler, *args):
+    # older reader that returns everything as one string
+    (status, data) = handler(*args, False, None)
+    if status < 1400 and data:
+        yield bytes(data, "utf-8")
+    return status
+
+
+class LegacyStream():
+    """ Stands in for the request handler passed to an older streaming
+    reader; what it writes to stream.wfile is gathered into chunks of
+    about buffer_size bytes and queued for the server.
+
+    Chunks are cut at line ends, so each holds whole records as the
+    reader protocol promises; an unfinished last line waits for the
+    next write, or for close().
+    """
+    def __init__(self, maxsize, buffer_size, flush_interval):
+        self.wfile = hapi_output.BufferedWriter(self, buffer_size,
+                                                flush_interval)
+        self.q = queue.Queue(maxsize=maxsize)
+        self.aborted = False
+        self.partial = b''  # unfinished last line of the writes so far
+
+    def write(self, data):
+        n = len(data)
+        data = self.partial + bytes(data)
+        cut = data.rfind(b'\n') + 1
+        (data, self.partial) = (data[:cut], data[cut:])
+        if data:
+            self.put(data)
+        return n
+
+    def put(self, data):
+        # blocks while the client is LEGACY_QUEUE_CHUNKS chunks behind
+        while True:
+            if self.aborted:
+                raise BrokenPipeError("client disconnected")
+            try:
+                self.q.put(('data', data), timeout=1.0)
+                return
+            except queue.Full:
+                pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        # what is buffered, then a last line without its line end
+        self.wfile.close()
+        if self.partial:
+            self.put(self.partial)
+            self.partial = b''
+
+
+def legacy_streamed(handler, stream, *args):
+    # older reader writing to stream.wfile: run it in a helper thread so
+    # its writes arrive here as chunks, a few queued ahead of the client
+    def work():
+        result = ('error', None)
+        try:
+            (status, data) = handler(*args, True, stream)
+            if status < 1400 and data:
+                # some readers return their last piece instead of writing it
+                stream.wfile.write(bytes(data, "utf-8"))
+            stream.close()
+            result = ('done', status)
+        except BrokenPipeError:
+            result = ('done', 1500)
+        finally:
+            stream.q.put(result)
+
+    worker = threading.Thread(target=work, name='hapi-legacy-reader')
+    worker.daemon = True
+    worker.start()
+    try:
+        while True:
+            (kind, item) = stream.q.get()
+            if kind == 'data':
+                yield item
+            elif kind == 'done':
+                return item
+            else:
+                raise RuntimeError("reader %s failed" % handler.__name__)
+    finally:
+        # the client went away: unblock the reader so it can stop
+        stream.aborted = True
+        while worker.is_alive():
+            try:
+                stream.q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
@@ -12,7 +12,7 @@ The code and documentation resides at
     https://github.com/hapi-server/server-python
 
 Usage:
-  python hapi_server.py <MISSIONNAME> [localhost/http/https/custom]
+  python hapi_server.py <MISSIONNAME> [localhost/http/https/custom] [--workers N]
 (If no arguments provided, defaults to 'csv' and 'localhost')
 
 where MISSIONNAME points to the appropriation MISSIONNAME.config file
@@ -21,6 +21,8 @@ and:
    http:      server runs on port 80
    https:     server runs on port 443
    custom:    server runs on custom port that you hardcode into this code
+   --workers N: pre-fork N server processes sharing the port (default 1),
+                so CPU-bound readers can use more than one core
 
 Configuration requirements
 * capabilities and catalog responses must be formatted as JSON in SERVER_HOME
@@ -58,6 +60,30 @@ Dev notes:
   server3h: added customRequestionOptions
   server3i: refactored for readability
   server3j: choice to stream per-file data or wait for all data then serve
+  server3k: optional fixed worker pool (server_mode='pool') with a bounded
+            queue, load visible at hapi/x_status
+  server3l: --workers N pre-forks supervised server processes on one port
+  server3m: asyncio front end (server_mode='async'), see hapi_async.py
+  server3n: HTTP/1.1 keep-alive, chunked transfer encoding when streaming
+  server3o: gzip/zstd response compression via Accept-Encoding
+  server3p: capabilities/catalog/info served from memory (hapi_metadata.py),
+            re-read when changed on disk or on SIGHUP
+  server3q: ETag/If-None-Match and Cache-Control on capabilities/catalog/info
+  server3r: LRU cache of data responses (hapi_cache.py)
+  server3s: identical concurrent data requests share one reader run
+  server3t: readers yield chunks of bytes (hapi_reader.py), older readers
+            are adapted, the server owns buffering, trimming and errors
+  server3u: streamed output is gathered into write_buffer_size blocks
+  server3v: reader output trimmed to the requested range by binary search
+  server3w: time.min/time.max keep seconds and fractions (and YYYY-DOY)
+  server3x: in-memory index of data day files (hapi_fileindex.py)
+  server3y: readers may hand over file ranges, sent with os.sendfile
+  server3z: next data files read ahead on a thread pool (read_ahead_files)
+  server4a: column copies of CSV day files (hapi_sidecar.py)
+  server4b: pre-aggregated coarser cadences, x_customRequestOptions.resolution
+            (hapi_pyramid.py)
+  server4c: any reader's output binned on the fly, x_customRequestOptions.bin
+            (hapi_binning.py)
 
 On Python2 versus Python3:
   difference between Python3 as provided to github and APL-site specific
@@ -84,12 +110,28 @@ noisy=False   #set True for unix command line feedback
 import os.path
 import sys # only used for command-line arguments
 import time
+import io
+import json
+import queue
+import signal
+import socket
+import threading
 from time import gmtime, strftime
 from email.utils import parsedate_tz,formatdate
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from socketserver import ThreadingMixIn
 import urllib.parse as urlparse
 import hapi_parser as hp
+import csv_hapireader
+import hapi_async
+import hapi_cache
+import hapi_fileindex
+import hapi_output
+import hapi_reader
+import hapi_binning
+import hapi_metadata
+import hapi_pyramid
+import hapi_sidecar
 if (isPi):
     import RPi.GPIO as GPIO
 
@@ -97,9 +139,19 @@ if (isPi):
 
 ### GET COMMAND LINE ARGUMENTS FOR HOW TO RUN ###
 # If none provided, defaults to 'csv' and 'localhost'
-# python hapi_server.py <MISSIONNAME> [localhost/http/https/custom]
+# python hapi_server.py <MISSIONNAME> [localhost/http/https/custom] [--workers N]
+ARGS = sys.argv[1:]
+WORKERS = None  # None = use the config file 'workers' setting
+if '--workers' in ARGS:
+    i = ARGS.index('--workers')
+    try:
+        WORKERS = int(ARGS[i+1])
+    except:
+        print("Error, --workers needs a number of processes, exiting")
+        exit()
+    del ARGS[i:i+2]
 try:
-    USE_CASE = str(sys.argv[1])
+    USE_CASE = str(ARGS[0])
 except:
     USE_CASE = 'csv'
     # APL choices are 'csv', 'guvi', 'guviaws', or 'supermag'
@@ -107,7 +159,7 @@ except:
 # Arg 2 can be 'localhost', 'http', 'https', or 'custom'
 # Use 'custom' if need you need to mod this code to define a non-standard port
 try:
-    LOCALITY = str(sys.argv[2])
+    LOCALITY = str(ARGS[1])
 except:
     LOCALITY = 'localhost'
 
@@ -132,6 +184,8 @@ print("Running in",LOCALITY,"mode, initializing for",USE_CASE)
 
 ### GET AND PARSE CONFIG FILE ###
 CFG = hp.parse_config(USE_CASE)
+if WORKERS is not None:
+    CFG.workers = WORKERS # command line wins over the config file
 
 if CFG.api_datatype == 'aws':
     import s3netcdf
@@ -140,6 +194,73 @@ if CFG.api_datatype == 'aws':
 # (mostly needed for id/dataset, time.min/start, time.max/stop keywords)
 hapi_version = hp.get_hapiversion(CFG.HAPI_HOME)
 
+### capabilities, catalog and info JSON are served from memory
+META = hapi_metadata.MetadataRegistry(CFG.HAPI_HOME,
+                                      CFG.metadata_check_interval)
+META.load_all()
+
+### data files of 'file' datasets, indexed once (see hapi_fileindex.py)
+hapi_fileindex.INDEX.check_interval = CFG.file_index_interval
+hapi_fileindex.INDEX.template = CFG.file_template
+hapi_fileindex.INDEX.templates = dict(CFG.file_templates)
+for template in [CFG.file_template] + list(CFG.file_templates.values()):
+    hapi_fileindex.Template(template, '') # ValueError for a bad layout now
+if CFG.api_datatype == 'file':
+    hapi_fileindex.INDEX.load_all([CFG.HAPI_HOME + 'data/' + id
+                                   for id in hp.get_all_ids(CFG.HAPI_HOME)])
+
+### column copies of CSV day files, see hapi_sidecar.py (off unless
+### the config file sets sidecar_dir)
+if CFG.sidecar_dir and CFG.api_datatype == 'file':
+    if hapi_sidecar.numpy is None:
+        print("Note sidecar_dir needs numpy, which is not installed; not used")
+    else:
+        hapi_sidecar.SIDECARS = hapi_sidecar.SidecarStore(
+            CFG.sidecar_dir, CFG.HAPI_HOME + 'info/', CFG.sidecar_interval)
+
+### coarser cadences of CSV datasets whose info offers them, aggregated
+### per request; kept ahead when the config file sets pyramid_dir, see
+### hapi_pyramid.py
+if CFG.hapi_handler is csv_hapireader.iter_data_csv and hapi_pyramid.numpy is None:
+    metas = [META.dataset(id) for id in hp.get_all_ids(CFG.HAPI_HOME)]
+    if any(hapi_pyramid.offered_resolutions(meta.xopts)
+           for meta in metas if meta is not None):
+        print("Note x_customRequestOptions.resolution needs numpy, which is not installed; ignored")
+if CFG.pyramid_dir and CFG.api_datatype == 'file':
+    if hapi_pyramid.numpy is None:
+        print("Note pyramid_dir needs numpy, which is not installed; not used")
+    else:
+        hapi_pyramid.PYRAMIDS = hapi_pyramid.PyramidStore(
+            CFG.pyramid_dir, CFG.HAPI_HOME + 'info/', CFG.pyramid_levels,
+            CFG.pyramid_interval)
+
+### request options for binning any reader's output on the fly, see
+### hapi_binning.py (off unless the config file sets downsample_bins)
+BIN_OPTIONS = []
+if CFG.downsample_bins:
+    if hapi_binning.numpy is None:
+        print("Note downsample_bins needs numpy, which is not installed; not used")
+    else:
+        BIN_OPTIONS = hapi_binning.request_options(CFG.downsample_bins)
+
+### data files read ahead of the client, see hapi_reader.Prefetcher
+hapi_reader.PREFETCH = hapi_reader.Prefetcher(CFG.read_threads,
+                                              CFG.read_ahead_files)
+
+### recently served data bodies, see hapi_cache.py (cache_max_bytes=0: off)
+if CFG.cache_max_bytes > 0:
+    CACHE = hapi_cache.DataCache(CFG.cache_max_bytes,
+                                 CFG.cache_entry_max_bytes,
+                                 CFG.cache_ttl, CFG.cache_ttl_recent,
+                                 CFG.cache_dir, CFG.cache_disk_max_bytes)
+else:
+    CACHE = None
+# identical data requests in progress, see hapi_cache.Flights
+if CFG.coalesce_requests:
+    FLIGHTS = hapi_cache.Flights(CFG.cache_entry_max_bytes)
+else:
+    FLIGHTS = None
+
 # below now moved to info/*.json instead of capabilities.json
 ### potential "x_*" parameters in capabilities.json extracted here
 ##try:
@@ -232,25 +353,326 @@ def get_forwarded(headers):
     else:
         return None 
 
-def get_last_line(s: str) -> str:
-    # Strip any trailing newlines (\n, \r\n, or combos)
-    i = len(s) - 1
-    while i >= 0 and s[i] in ('\n', '\r'):
-        i -= 1
-    if i < 0:
-        return ''
-    # Now search backwards for the previous newline
-    j = i
-    while j >= 0 and s[j] not in ('\n', '\r'):
-        j -= 1
-    return s[j + 1:i + 1]
+def compress_level(encoding):
+    # mission's configured compression level for gzip or zstd
+    if encoding == 'zstd':
+        return CFG.zstd_level
+    return CFG.gzip_level
+
+def bin_options(mydata):
+    # the BIN_OPTIONS a dataset takes: those it does not define itself
+    try:
+        own = [opt['name'] for opt in mydata['x_customRequestOptions']]
+    except (KeyError, TypeError):
+        own = []
+    return [opt for opt in BIN_OPTIONS if opt['name'] not in own]
+
+def bin_plan(mydata, options):
+    # hapi_binning.Plan of a data request's validated custom options, or
+    # None; options of the dataset's own with the same names do not count
+    names = [opt['name'] for opt in bin_options(mydata)]
+    if 'bin' not in names:
+        return None
+    return hapi_binning.plan([opt for opt in options
+                              if opt.split('=', 1)[0] in names])
+
+def make_binner(timemin, parameters, mydata, floc):
+    # hapi_binning stage for a data request that asks for bins, or None
+    plan = bin_plan(mydata, floc['customOptions'])
+    if plan is None:
+        return None
+    (dtypes, fills) = (None, None)
+    if hasattr(mydata, 'parameters_map'):
+        # types and fills of the columns the reader sends
+        mm = mydata.parameters_map(parameters)
+        cols = [li for i in mm for li in mm[i]]
+        try:
+            alltypes = hapi_sidecar.column_dtypes(mydata)
+            allfills = hapi_binning.column_fills(mydata)
+            dtypes = [alltypes[li] for li in cols]
+            fills = [allfills[li] for li in cols]
+        except (KeyError, TypeError, IndexError):
+            (dtypes, fills) = (None, None)
+    return hapi_binning.Binner(plan, timemin, dtypes, fills)
+
+def server_status(server):
+    # load figures for the hapi/x_status endpoint
+    if hasattr(server, 'pool_stats'):
+        status = server.pool_stats()
+    else:
+        status = {'mode': 'threaded', 'threads': threading.active_count()}
+    if CACHE is not None:
+        status['cache'] = CACHE.stats()
+    if FLIGHTS is not None:
+        status['flights'] = FLIGHTS.stats()
+    if hapi_sidecar.SIDECARS is not None:
+        status['sidecars'] = hapi_sidecar.SIDECARS.stats()
+    if hapi_pyramid.PYRAMIDS is not None:
+        status['pyramid'] = hapi_pyramid.PYRAMIDS.stats()
+    status['pid'] = os.getpid()
+    return status
 
 ### THE HAPI SERVER ###
     
 class MyHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 lets clients reuse one connection for capabilities, info
+    # and data requests; bodies are framed by Content-Length or chunks
+    protocol_version = 'HTTP/1.1'
+
     def log_message(self, format, *args):
         return
 
+    def setup(s):
+        BaseHTTPRequestHandler.setup(s)
+        # like socketserver's wfile, but file ranges can use os.sendfile
+        s.wfile = hapi_output.SocketWriter(s.connection)
+
+    def handle_one_request(s):
+        # idle keep-alive connections are only held for keepalive_timeout
+        s.connection.settimeout(CFG.keepalive_timeout)
+        try:
+            BaseHTTPRequestHandler.handle_one_request(s)
+        finally:
+            # a failed request may leave a body writer in place of wfile
+            s.wfile = getattr(s, 'raw_wfile', s.wfile)
+        pending = getattr(s.server, 'pending', None)
+        if pending is not None and not pending.empty():
+            # pool mode: hand this worker to a waiting connection
+            s.close_connection = True
+
+    def parse_request(s):
+        ok = BaseHTTPRequestHandler.parse_request(s)
+        s.connection.settimeout(None) # no limit once a request arrives
+        return ok
+
+    def send_response(s, code, message=None):
+        s.response_code = code
+        BaseHTTPRequestHandler.send_response(s, code, message)
+
+    def begin_body(s, streamed):
+        # Called once all headers but the framing ones are set.
+        # Buffered bodies are collected and sent with a Content-Length;
+        # streamed ones go out as HTTP/1.1 chunks as readers write them.
+        # Bodies are compressed when the client accepts one of the
+        # mission's CFG.compression encodings (buffered ones only if at
+        # least CFG.compress_min_size bytes).  Streamed writes are first
+        # gathered into CFG.write_buffer_size blocks.
+        s.raw_wfile = s.wfile
+        s.encoding = hapi_output.choose_encoding(
+            s.headers.get('Accept-Encoding', ''), CFG.compression)
+        if s.encoding is not None:
+            s.send_header("Vary", "Accept-Encoding")
+        if not streamed:
+            s.wfile = io.BytesIO()
+            return
+        chunked = s.request_version == 'HTTP/1.1'
+        if chunked:
+            s.send_header("Transfer-Encoding", "chunked")
+        else:
+            # older clients: the end of the body is the end of the connection
+            s.send_header("Connection", "close")
+        if s.encoding is not None:
+            s.send_header("Content-Encoding", s.encoding)
+        s.end_headers()
+        if chunked:
+            s.wfile = hapi_output.ChunkedWriter(s.wfile)
+        if s.encoding is not None:
+            s.wfile = hapi_output.CompressWriter(
+                s.wfile, s.encoding, compress_level(s.encoding),
+                CFG.compressed_passthrough)
+        s.wfile = hapi_output.BufferedWriter(s.wfile, CFG.write_buffer_size,
+                                             CFG.write_flush_interval)
+
+    def end_body(s):
+        body = s.wfile
+        s.wfile = s.raw_wfile
+        if isinstance(body, hapi_output.BufferedWriter):
+            body.close()
+            body = body.raw
+        if isinstance(body, hapi_output.CompressWriter):
+            body.close()
+            body = body.raw
+        if isinstance(body, io.BytesIO):
+            data = body.getvalue()
+            if ( s.encoding is not None and
+                 len(data) >= CFG.compress_min_size ):
+                data = hapi_output.compress(data, s.encoding,
+                                            compress_level(s.encoding))
+                s.send_header("Content-Encoding", s.encoding)
+            s.send_header("Content-Length", str(len(data)))
+            s.end_headers()
+            s.wfile.write(data)
+        elif isinstance(body, hapi_output.ChunkedWriter):
+            body.close()
+
+    def check_etag(s, tag, size, responseHeaders):
+        # Adds ETag and Cache-Control for a metadata response of size bytes
+        # to responseHeaders.  Each content-coding is its own representation,
+        # so a compressed body gets the encoding appended to its tag.  If
+        # the client's If-None-Match already covers it, sends the 304 and
+        # returns True.
+        encoding = hapi_output.choose_encoding(
+            s.headers.get('Accept-Encoding', ''), CFG.compression)
+        if encoding is not None and size >= CFG.compress_min_size:
+            etag = '"%s-%s"' % (tag, encoding)
+        else:
+            etag = '"%s"' % tag
+        responseHeaders['ETag'] = etag
+        responseHeaders['Cache-Control'] = 'public, max-age=%d' % (
+            CFG.metadata_max_age)
+        theyHave = s.headers.get('If-None-Match')
+        if theyHave is None:
+            return False
+        # weak comparison (RFC 9110), and a tag from another encoding of
+        # the same content still counts as current
+        current = False
+        for their in theyHave.split(','):
+            their = their.strip()
+            if their.startswith('W/'):
+                their = their[2:]
+            if their == '*' or their.strip('"').split('-')[0] == tag:
+                current = True
+        if not current:
+            return False
+        s.send_response(304)
+        if encoding is not None:
+            s.send_header("Vary", "Accept-Encoding")
+        for h in responseHeaders:
+            s.send_header(h,responseHeaders[h])
+        s.end_headers()
+        return True
+
+    def send_data(s, id, timemin, timemax, parameters, mydata, floc, query):
+        # data body, from the response cache when an identical request
+        # was answered recently, or shared with an identical request
+        # that is being answered right now
+        if CACHE is None and FLIGHTS is None:
+            s.run_reader(id, timemin, timemax, parameters, mydata, floc)
+            return
+        key = hapi_cache.data_key(USE_CASE, id, timemin, timemax, parameters,
+                                  floc['customOptions'],
+                                  query.get('format', ['csv'])[0])
+        if CACHE is not None:
+            data = CACHE.get(key)
+            if data is not None:
+                s.wfile.write(data)
+                return
+        (flight, leader) = (None, False)
+        if FLIGHTS is not None:
+            (flight, leader) = FLIGHTS.join(key, s.wfile)
+            if flight is not None and not leader:
+                flight.replay(s.wfile)
+                return
+        if leader:
+            capture = flight
+        elif CACHE is not None:
+            capture = CACHE.capture(s.wfile)
+        else:
+            s.run_reader(id, timemin, timemax, parameters, mydata, floc)
+            return
+        s.wfile = capture
+        status = 1500
+        try:
+            status = s.run_reader(id, timemin, timemax, parameters, mydata,
+                                  floc)
+        finally:
+            s.wfile = capture.raw
+            if CACHE is not None and status == 1200:
+                CACHE.put(key, capture.getvalue(), timemax)
+            if leader:
+                FLIGHTS.land(key, flight, status)
+
+    def run_reader(s, id, timemin, timemax, parameters, mydata, floc):
+        # runs the mission's reader and writes its output (or the HAPI
+        # error); returns 1200 if data was served
+        # FORMAT HERE IS: id (unique dataset endpoint)
+        #    timemin and timemax (in HAPI format)
+        #    parameters (as a list of parameter names)
+        #    mydata (read-only json-parsed info, a DatasetMeta)
+        #    floc (site-specific required elements from *_config.py)
+        # Readers hand over chunks of records (see hapi_reader.py); how
+        # they reach the client (buffered, chunked, compressed) is up to
+        # s.wfile, set up by begin_body.
+        run = hapi_reader.open_reader(CFG.hapi_handler, id, timemin, timemax,
+                                      parameters, mydata, floc,
+                                      CFG.stream_flag, CFG.write_buffer_size,
+                                      CFG.write_flush_interval)
+        # readers may deliver whole files; only [timemin, timemax) is sent
+        window = hp.TimeWindow(timemin, timemax)
+        # records binned on the way out, if the request asks for that
+        binner = make_binner(timemin, parameters, mydata, floc)
+        sent = False
+        unreadable = False # records trimming or binning could not read
+        partial = b'' # unfinished last line of the chunks so far
+
+        def emit(records):
+            # trims (and bins) whole records and sends what is left;
+            # False if they could not be read
+            nonlocal sent
+            try:
+                records = window.trim(records)
+                if binner is not None and records:
+                    records = binner.feed(records)
+            except (ValueError, OverflowError):
+                return False
+            if records:
+                s.wfile.write(records)
+                sent = True
+            return True
+
+        try:
+            for chunk in run:
+                if isinstance(chunk, hapi_reader.FileRange):
+                    if binner is None and not partial:
+                        # already inside the window, straight from the file
+                        if chunk.count > 0:
+                            chunk.send(s.wfile)
+                            sent = True
+                        continue
+                    chunk = chunk.read()
+                # trimming needs whole records, keep a split one for later
+                if partial:
+                    chunk = partial + chunk
+                cut = chunk.rfind(b'\n') + 1
+                (chunk, partial) = (chunk[:cut], chunk[cut:])
+                if chunk and not emit(chunk):
+                    unreadable = True
+                    break
+                if window.past_end:
+                    # the rest is after timemax too, stop reading
+                    break
+            if partial and not (unreadable or window.past_end):
+                # a last record without its line end
+                unreadable = not emit(partial)
+            if binner is not None and not unreadable:
+                try:
+                    chunk = binner.finish()
+                except ValueError:
+                    (chunk, unreadable) = (b'', True)
+                if chunk:
+                    s.wfile.write(chunk)
+                    sent = True
+        except OSError:
+            # client went away, nobody left to tell
+            return 1500
+        finally:
+            run.close()
+        status = run.status
+        if unreadable:
+            status = 1500 # records the trimming or binning could not read
+        elif status is None:
+            status = 1200 # reader stopped early, past timemax
+        #print('superhapi',status,sent)
+        if status >= 1400:
+            s.do_error(status)
+        elif status == 1201 or not sent:
+            # status 1201 is HAPI "OK- no data for time range"
+            status = 1201
+            s.do_error(status)
+        else:
+            status = 1200 # status 1200 is HAPI "OK"
+        return status
+
     def do_error(s,code,alt=400):
         msg=hp.hapi_errors(code)
         # try/except here to handle cases of broken pipe
@@ -263,6 +685,7 @@ class MyHandler(BaseHTTPRequestHandler):
     def do_HEAD(s):
         s.send_response(200)
         s.send_header("Content-Type", "application/json")
+        s.send_header("Content-Length", "0")
         s.end_headers()
 
     def do_GET(s):
@@ -283,30 +706,44 @@ class MyHandler(BaseHTTPRequestHandler):
         # HTML HEADERS
         #
         if ( path=='hapi/capabilities' ):                
+           (body, etag) = META.capabilities_entity()
+           if s.check_etag(etag, len(body), responseHeaders):
+               feedback.finish(responseHeaders)
+               return
            s.send_response(200)
            s.send_header("Content-Type", "application/json")
 
         elif ( path=='hapi/catalog' ):
+           (body, etag) = META.catalog_entity()
+           if s.check_etag(etag, len(body), responseHeaders):
+               feedback.finish(responseHeaders)
+               return
            s.send_response(200)
            s.send_header("Content-Type", "application/json")
 
         elif ( path=='hapi/info' ):
            id= query['id'][0]
-           if ( os.path.isfile(CFG.HAPI_HOME + 'info/' + id + '.json' ) ):
+           parameters= hp.handle_key_parameters(query)
+           (body, etag) = META.info_entity(id, parameters, None)
+           if ( META.has_info(id) ):
+               if s.check_etag(etag, len(body), responseHeaders):
+                   feedback.finish(responseHeaders)
+                   return
                s.send_response(200)
            else:
-               #s.send_response(404)
-               s.do_error(1406,404)   # 'unknown dataset id'
+               body = None
+               s.send_response(404)   # body is HAPI 1406, 'unknown dataset id'
            s.send_header("Content-Type", "application/json")
 
         elif ( path=='hapi/data' ):
            id= query['id'][0]
            (timemin, timemax, errorcode) = hp.clean_query_time(query)
            #print('superhapi',timemin,timemax,errorcode,id,query)
-           if errorcode > 0:
-               s.do_error(errorcode)
-           lastModified = hp.get_lastModified(CFG.api_datatype, id, CFG.HAPI_HOME, timemin, timemax)
-           if ( s.headers.__contains__('If-Modified-Since') ):
+           known = META.has_info(id)
+           if errorcode == 0 and known:
+               # only datasets with an info file get their files looked at
+               lastModified = hp.get_lastModified(CFG.api_datatype, id, CFG.HAPI_HOME, timemin, timemax)
+           if ( errorcode == 0 and known and s.headers.__contains__('If-Modified-Since') ):
                theyHave = hp.fetch_modifiedsince(s.headers['If-Modified-Since'])
                if ( lastModified <= theyHave ):
                    s.send_response(304)
@@ -314,12 +751,20 @@ class MyHandler(BaseHTTPRequestHandler):
                    feedback.finish(responseHeaders)
                    return               
            # check request header for If-Modified-Since
-           if ( os.path.isfile(CFG.HAPI_HOME + 'info/' + id + '.json' ) ):
+           if errorcode > 0:
+               s.send_response(400)
+               s.send_header("Content-Type", "application/json")
+           elif ( known ):
                s.send_response(200)
                s.send_header("Content-Type", "text/csv")
            else:
                s.send_response(404)
 
+        elif ( path=='hapi/x_status' ):
+           # server load, e.g. worker pool queue depth
+           s.send_response(200)
+           s.send_header("Content-Type", "application/json")
+
         elif ( path=='hapi' ):
            s.send_response(200)
            s.send_header("Content-Type", "text/html")
@@ -338,7 +783,7 @@ class MyHandler(BaseHTTPRequestHandler):
         s.send_header("Access-Control-Allow-Methods", "GET")
         s.send_header("Access-Control-Allow-Headers", "Content-Type")
 
-        if ( path=='hapi/data' ):
+        if ( path=='hapi/data' and errorcode == 0 and known ):
             ###from email.utils import formatdate
             responseHeaders['Last-Modified']=formatdate(
                 timeval=lastModified, localtime=False, usegmt=True ) 
@@ -346,27 +791,31 @@ class MyHandler(BaseHTTPRequestHandler):
         for h in responseHeaders:
             s.send_header(h,responseHeaders[h])
             
-        s.end_headers()
+        # per-file streaming readers send data as it is read, in chunks
+        s.begin_body( path=='hapi/data' and CFG.stream_flag
+                      and s.response_code==200 )
 
         #
         # HTML BODY
         #
-        if ( path=='hapi/capabilities' ):
-            for l in open( CFG.HAPI_HOME + 'capabilities.json' ):
-                s.wfile.write(bytes(l,"utf-8"))
-        elif ( path=='hapi/catalog' ):
-            for l in open( CFG.HAPI_HOME + 'catalog.json' ):
-                s.wfile.write(bytes(l,"utf-8"))
-        elif ( path=='hapi/info' ):
-            id= query['id'][0]
-            #for l in open( CFG.HAPI_HOME + '/info/' + id + '.json' ):
-            #    s.wfile.write(bytes(l,"utf-8"))
-            parameters= hp.handle_key_parameters(query)
-            para = hp.do_write_info(id, parameters, CFG.HAPI_HOME, None )
-            s.wfile.write(bytes(para,"utf-8"))
+        if ( path=='hapi/info' and body is None ):
+            s.do_error(1406)
+        elif ( path in ('hapi/capabilities', 'hapi/catalog', 'hapi/info') ):
+            # metadata body, already fetched alongside its ETag
+            s.wfile.write(body)
+        elif ( path=='hapi/data' and errorcode > 0 ):
+            s.do_error(errorcode)
         elif ( path=='hapi/data' ):
-            (parameters, xopts, mydata, check_error) = hp.prep_data(query, CFG.HAPI_HOME, tags)
-            CFG.floc['customOptions'] = hp.handle_customRequestOptions(query, xopts)
+            # info/[id].json is parsed once (cached) and shared by the
+            # checks, the header and the reader for this request
+            meta = META.dataset(id)
+            (parameters, xopts, mydata, check_error) = hp.prep_data(query, CFG.HAPI_HOME, tags, meta)
+            # binning is offered for every dataset that does not use the
+            # names for its own options
+            xopts = xopts + bin_options(mydata)
+            # per-request copy, so concurrent requests keep their own options
+            floc = dict(CFG.floc)
+            floc['customOptions'] = hp.handle_customRequestOptions(query, xopts)
             #print('superhapi',xopts,mydata,check_error,parameters,query)
             if check_error > 0:
                 s.do_error(check_error)
@@ -374,46 +823,23 @@ class MyHandler(BaseHTTPRequestHandler):
                 # parameters are valid, so run the query
                 if query.__contains__('include'):
                     if query['include'][0]=='header':
-                        info = hp.do_write_info(id, parameters, CFG.HAPI_HOME, '#' )
-                        s.wfile.write(bytes(info,"utf-8"))
-                (stat,mydata)=hp.fetch_info_params(id,CFG.HAPI_HOME,False)
-                #print('superhapi',stat,mydata)
-                # FORMAT HERE IS: id (unique dataset endpoint)
-                #    timemin and timemax (in HAPI format)
-                #    parameters (as a list of parameter names)
-                #    mydata (copy of the full json-parsed parameters spec)
-                #    floc (site-specific required elements from *_config.py)
-                (status,data)=CFG.hapi_handler(
-                    id, timemin, timemax, parameters, mydata, CFG.floc,
-                    CFG.stream_flag, s)
-                #print('superhapi',status,data)
-                if status >= 1400:
-                    s.do_error(status)
-                else:
-                    if len(data) == 0 and CFG.stream_flag == False:
-                        # likely redundant sanity check
-                        status = 1201
-                    if status == 1201:
-                        # status 1201 is HAPI "OK- no data for time range"
-                        s.do_error(status)
-                    else:
-                        status=1200 # status 1200 is HAPI "OK"
-                    # presumed valid data, so serve it
-
-                    try:
-                        truestart = data[0:22].split(',')[0]
-                        trueend = get_last_line(data).split(',')[0]
-                        if hp.compare_times(truestart,timemin) == 'before' or hp.compare_times(trueend, timemax) == 'after':
-                            data = hp.truncate_data(timemin, timemax, data)
-                    except:
-                        pass # in case of weird time formats, etc
-                    
-                    try:
-                        # note for streaming, data is zero but legit
-                        s.wfile.write(bytes(data,"utf-8"))
-                    except:
-                        # return general 'user input error' code 
-                        s.do_error(1500) # HAPI internal server error
+                        # aggregated data says so in its header
+                        overrides = {}
+                        if CFG.hapi_handler is csv_hapireader.iter_data_csv:
+                            # the one reader that aggregates by resolution
+                            plan = hapi_pyramid.plan(floc['customOptions'])
+                            if plan is not None:
+                                overrides.update(plan.header())
+                        plan = bin_plan(mydata, floc['customOptions'])
+                        if plan is not None:
+                            overrides.update(plan.header())
+                        s.wfile.write(META.info(id, parameters, '#',
+                                                overrides or None))
+                s.send_data(id, timemin, timemax, parameters, mydata, floc,
+                            query)
+
+        elif ( path=='hapi/x_status' ):
+            s.wfile.write(bytes(json.dumps(server_status(s.server)),"utf-8"))
 
         elif ( path=='hapi' ):
             page = hp.print_hapi_intropage(USE_CASE, CFG.HAPI_HOME, CFG.title)
@@ -427,19 +853,265 @@ class MyHandler(BaseHTTPRequestHandler):
             # looks like error is 'not a known URL'
             s.do_error(1400)
 
+        s.end_body()
         feedback.finish(responseHeaders)
 
 class ThreadedHTTPServer( ThreadingMixIn, HTTPServer ):
    '''Handle requests in a separate thread.'''
 
+class PooledHTTPServer( HTTPServer ):
+    '''Handle requests with a fixed pool of worker threads.
+
+    Accepted connections wait in a bounded queue for the next free worker.
+    When the queue is full the connection is refused right away with a
+    503 and a HAPI 1500 status, so peak threads (and memory) stay capped
+    no matter how many year-long data requests arrive at once.
+    '''
+    daemon_threads = True
+
+    def __init__(self, server_address, RequestHandlerClass,
+                 bind_and_activate=True, workers=8, queue_size=32):
+        HTTPServer.__init__(self, server_address, RequestHandlerClass,
+                            bind_and_activate)
+        self.pending = queue.Queue(maxsize=queue_size)
+        self.stats_lock = threading.Lock()
+        self.busy = 0
+        self.served = 0
+        self.rejected = 0
+        self.workers = []
+        for i in range(workers):
+            t = threading.Thread(target=pool_worker, args=(self,),
+                                 name='hapi-worker-%d' % i)
+            t.daemon = self.daemon_threads
+            t.start()
+            self.workers.append(t)
+
+    def process_request(self, request, client_address):
+        # called from the accept loop, so this must never block
+        try:
+            self.pending.put_nowait((request, client_address))
+        except queue.Full:
+            with self.stats_lock:
+                self.rejected += 1
+            self.reject_request(request)
+            self.shutdown_request(request)
+
+    def reject_request(self, request):
+        msg = hp.hapi_errors(1500) + '-- server busy, retry later'
+        body = bytes('{"HAPI": "3.1","status":{"code":1500,"message":"%s"} }'
+                     % msg, "utf-8")
+        head = ("HTTP/1.0 503 Service Unavailable\r\n"
+                "Content-Type: application/json\r\n"
+                "Access-Control-Allow-Origin: *\r\n"
+                "Retry-After: 1\r\n"
+                "Content-Length: %d\r\n"
+                "Connection: close\r\n\r\n" % len(body))
+        try:
+            request.settimeout(1.0)
+            request.sendall(bytes(head,"utf-8") + body)
+        except OSError:
+            pass # client already gone
+
+    def pool_stats(self):
+        with self.stats_lock:
+            return {'mode': 'pool',
+                    'workers': len(self.workers),
+                    'busy': self.busy,
+                    'queued': self.pending.qsize(),
+                    'queue_size': self.pending.maxsize,
+                    'served': self.served,
+                    'rejected': self.rejected}
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        # let queued requests finish, then stop each worker
+        for t in self.workers:
+            self.pending.put((None, None))
+        for t in self.workers:
+            t.join()
+
+def pool_worker(server):
+    # worker loop for PooledHTTPServer, one per pool thread
+    while True:
+        (request, client_address) = server.pending.get()
+        if request is None:
+            break
+        with server.stats_lock:
+            server.busy += 1
+        try:
+            server.finish_request(request, client_address)
+        except Exception:
+            server.handle_error(request, client_address)
+        finally:
+            server.shutdown_request(request)
+            with server.stats_lock:
+                server.busy -= 1
+                server.served += 1
+
+def make_server(host, port, reuse_port=False, sock=None):
+    # build the HTTP server selected by CFG.server_mode
+    # reuse_port: bind with SO_REUSEPORT so sibling processes share the port
+    # sock: already-listening socket (inherited from the pre-fork parent)
+    if CFG.server_mode == 'async':
+        return hapi_async.AsyncHAPIServer((host, port), MyHandler,
+                                          reuse_port, sock,
+                                          threads=CFG.async_threads,
+                                          queue_chunks=CFG.async_queue_chunks,
+                                          idle_timeout=CFG.keepalive_timeout)
+    if CFG.server_mode == 'pool':
+        httpd = PooledHTTPServer((host, port), MyHandler, False,
+                                 workers=CFG.pool_workers,
+                                 queue_size=CFG.pool_queue_size)
+    else:
+        httpd = ThreadedHTTPServer((host, port), MyHandler, False)
+    if sock is not None:
+        httpd.socket.close()
+        httpd.socket = sock
+        httpd.server_address = sock.getsockname()
+        return httpd
+    if reuse_port:
+        httpd.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    try:
+        httpd.server_bind()
+        httpd.server_activate()
+    except:
+        httpd.server_close()
+        raise
+    return httpd
+
+### PRE-FORKED WORKER PROCESSES (--workers N) ###
+
+def reload(signum, frame):
+    # SIGHUP: re-read metadata and data file lists, forget cached data
+    META.reload()
+    hapi_fileindex.INDEX.reload()
+    if CACHE is not None:
+        CACHE.clear()
+
+def serve_worker(reuse_port, sock):
+    # body of one pre-forked worker process
+    # Ctrl-C reaches the whole process group; let the supervisor decide
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    httpd = make_server(HOST_NAME, PORT_NUMBER, reuse_port, sock)
+    if hapi_sidecar.SIDECARS is not None:
+        # each worker tries; the lock in sidecar_dir lets one convert
+        hapi_sidecar.SIDECARS.start(hapi_fileindex.INDEX)
+    if hapi_pyramid.PYRAMIDS is not None:
+        hapi_pyramid.PYRAMIDS.start(hapi_fileindex.INDEX)
+    def drain(signum, frame):
+        # shutdown() waits for serve_forever, so it needs its own thread
+        threading.Thread(target=httpd.shutdown).start()
+    signal.signal(signal.SIGTERM, drain)
+    httpd.serve_forever()
+    httpd.server_close()  # waits for in-flight requests to finish
+
+def run_prefork(nworkers):
+    '''Pre-fork nworkers server processes that share one port, restart any
+    that die, and drain them all on SIGTERM/SIGINT.
+
+    With SO_REUSEPORT (Linux, BSD) each worker binds its own socket and the
+    kernel spreads connections between them; otherwise the workers share
+    a single listening socket opened here before forking.
+    '''
+    reuse_port = hasattr(socket, 'SO_REUSEPORT')
+    sock = None
+    if not reuse_port:
+        sock = socket.create_server((HOST_NAME, PORT_NUMBER), reuse_port=False)
+    children = {}   # pid: start time
+    stopping = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            if hasattr(signal, 'SIGHUP'):
+                # not the forwarding handler inherited through fork, which
+                # would pass the signal on to this worker's siblings
+                signal.signal(signal.SIGHUP, reload)
+            code = 0
+            try:
+                serve_worker(reuse_port, sock)
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = time.time()
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    def forward(signum, frame):
+        for pid in children:
+            os.kill(pid, signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, forward) # metadata reload
+    for i in range(nworkers):
+        spawn()
+    print(time.asctime(), "Started %d worker processes" % nworkers)
+
+    while not stopping:
+        (pid, status) = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            time.sleep(0.5)
+            continue
+        started = children.pop(pid, None)
+        if started is None or stopping:
+            continue
+        print(time.asctime(), "Worker %d exited (status %d), restarting"
+              % (pid, status))
+        if time.time() - started < 1.0:
+            time.sleep(1.0) # do not spin if workers die at startup
+        spawn()
+
+    # graceful drain: stop accepting, finish in-flight requests
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.time() + CFG.drain_timeout
+    while children and time.time() < deadline:
+        (pid, status) = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            time.sleep(0.1)
+        else:
+            children.pop(pid, None)
+    for pid in children:
+        print(time.asctime(), "Worker %d did not drain in time, killing" % pid)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    if sock is not None:
+        sock.close()
+
 
 ### AND HERE WE GO!
 
 if __name__ == '__main__':
     feedback.setup()
 
-    httpd = ThreadedHTTPServer((HOST_NAME, PORT_NUMBER), MyHandler)
-    print(time.asctime(), "Server Starts - %s:%s" % (HOST_NAME, PORT_NUMBER))
+    if hasattr(signal, 'SIGHUP'):
+        # 'kill -HUP <pid>' re-reads capabilities, catalog and info files
+        signal.signal(signal.SIGHUP, reload)
+
+    if CFG.workers > 1:
+        print(time.asctime(), "Server Starts - %s:%s (%d x %s mode)" % (
+            HOST_NAME, PORT_NUMBER, CFG.workers, CFG.server_mode))
+        run_prefork(CFG.workers)
+        feedback.destroy()
+        print(time.asctime(), "Server Stops - %s:%s" % (HOST_NAME, PORT_NUMBER))
+        sys.exit()
+
+    httpd = make_server(HOST_NAME, PORT_NUMBER)
+    if hapi_sidecar.SIDECARS is not None:
+        hapi_sidecar.SIDECARS.start(hapi_fileindex.INDEX)
+    if hapi_pyramid.PYRAMIDS is not None:
+        hapi_pyramid.PYRAMIDS.start(hapi_fileindex.INDEX)
+    print(time.asctime(), "Server Starts - %s:%s (%s mode)" % (
+        HOST_NAME, PORT_NUMBER, CFG.server_mode))
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
@@ -0,0 +1,274 @@
+""" hapi_sidecar.py, column copies of CSV day files
+
+ Part of the HAPI Python Server.  The code and documentation resides at:
+    https://github.com/hapi-server/server-python
+
+ Parameter-subset requests spend most of their time splitting CSV text.
+ When the config file sets sidecar_dir, a background thread saves every
+ data file of the 'file' datasets once more, as a numpy .npz of columns,
+ under the same path in sidecar_dir, e.g.
+     <sidecar_dir>/[id]/YYYY/[id].YYYYMMDD.csv.npz
+ The CSV reader then loads only the requested columns, and finds the
+ requested rows by binary search on the times.  Compressed day files
+ (.csv.gz and so on) get a sidecar of what they decode to.
+
+ Columns keep the text of the CSV fields, so responses are the same
+ bytes as from the CSV (turning float64 values back into text costs
+ more than splitting the CSV did).  Fields are checked against the type
+ their parameter has in info/[id].json (double, integer) when a sidecar
+ is built.
+
+ A sidecar holds the mtime and size of its day file and is only used
+ while they still match; it is rebuilt on the converter's next pass.
+ Files changed within the last check_interval seconds (still being
+ written) are left for a later pass, and files that do not parse into
+ columns (uneven lines, times out of order, fields not of their type)
+ are left as CSV.  With several worker processes, the one holding a
+ lock file in sidecar_dir does the converting.
+
+ Needs numpy; without it sidecars are not used.
+"""
+
+import abc
+import json
+import math
+import os
+import threading
+import time
+import traceback
+
+import hapi_output
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# added to the day file's name
+SUFFIX = '.npz'
+
+# numpy types fields of HAPI parameter types must parse as
+DTYPES = {'double': 'float64', 'integer': 'int64'}
+
+# records() formats this many rows per block
+BLOCK_ROWS = 4096
+
+# every byte but the field and record separators, see even_lines
+NOT_SEPARATORS = bytes(b for b in range(256) if b not in b',\n')
+
+
+def column_dtypes(info):
+    """ numpy dtype of each CSV column of a dataset, from its info
+    ('S' for times, strings and other types that are not checked) """
+    dtypes = []
+    for item in info['parameters']:
+        ncols = math.prod(item['size']) if item.get('size') else 1
+        dtypes.extend([DTYPES.get(item.get('type'), 'S')] * ncols)
+    return dtypes
+
+
+def even_lines(data, ncols):
+    """ True if every line of data (whole lines, each ending in LF) has
+    ncols fields.  Compares the separators alone, commas and line ends
+    in order, so extra and missing fields that even out are caught. """
+    seps = data.translate(None, NOT_SEPARATORS)
+    return seps == (b',' * (ncols - 1) + b'\n') * data.count(b'\n')
+
+
+def parse_columns(data, dtypes):
+    """ One array of field bytes per CSV column of data (whole lines);
+    raises ValueError when they do not parse as dtypes or the times are
+    out of order. """
+    data = data.replace(b'\r\n', b'\n')
+    if not data.endswith(b'\n'):
+        data += b'\n'
+    nlines = data.count(b'\n')
+    ncols = len(dtypes)
+    if not even_lines(data, ncols):
+        raise ValueError("lines do not all have %d fields" % ncols)
+    fields = data.replace(b'\n', b',').split(b',')
+    columns = []
+    for (li, dtype) in enumerate(dtypes):
+        col = numpy.array(fields[li:nlines * ncols:ncols])
+        if dtype != 'S':
+            col.astype(dtype)  # ValueError if a field is not a number
+        columns.append(col)
+    times = columns[0]
+    if len(times) > 1 and not numpy.all(times[:-1] <= times[1:]):
+        raise ValueError("times out of order")
+    return columns
+
+
+def records(npz, cols, keymin, keymax):
+    """ CSV records (a list of byte blocks) of columns cols of the rows
+    of a sidecar whose time is in [keymin, keymax), compared as bytes. """
+    times = npz['c0']
+    lo = int(numpy.searchsorted(times, numpy.bytes_(keymin), 'left'))
+    hi = int(numpy.searchsorted(times, numpy.bytes_(keymax), 'left'))
+    columns = {}
+    for li in cols:
+        if li not in columns:
+            columns[li] = npz['c%d' % li][lo:hi]
+    width = 2 * len(cols)  # each output field and the separator after it
+    blocks = []
+    for start in range(0, hi - lo, BLOCK_ROWS):
+        n = min(BLOCK_ROWS, hi - lo - start)
+        out = [b','] * (width * n)
+        for (j, li) in enumerate(cols):
+            out[2 * j::width] = columns[li][start:start + n].tolist()
+        out[width - 1::width] = [b'\n'] * n
+        blocks.append(b''.join(out))
+    return blocks
+
+
+class Builder(abc.ABC):
+    """ Base of the stores built in the background (SidecarStore and
+    hapi_pyramid.PyramidStore): their convert(index) pass runs every
+    check_interval seconds, in a thread of the one process holding the
+    lock file lockname in root; save() writes .npz files whole or not at
+    all. """
+    lockname = '.builder.lock'
+    threadname = 'hapi-builder'
+
+    def __init__(self, root, check_interval=300):
+        self.root = root
+        self.check_interval = check_interval
+        self.seen = {}   # file built: source it was built for
+        self.lockfile = None
+        self.built = 0
+        self.failed = 0
+
+    @abc.abstractmethod
+    def convert(self, index):
+        """ One pass over index (a hapi_fileindex.FileIndex). """
+
+    def save(self, path, arrays):
+        # write arrays to the .npz path, through a temporary file so
+        # readers never see half of one
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp, 'wb') as out:
+                numpy.savez(out, **arrays)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def converting(self):
+        # True if this process is (or now becomes) the one converting
+        if fcntl is None:
+            return True
+        if self.lockfile is not None:
+            return True
+        os.makedirs(self.root, exist_ok=True)
+        lockfile = open(os.path.join(self.root, self.lockname), 'w')
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lockfile.close()
+            return False
+        self.lockfile = lockfile
+        return True
+
+    def start(self, index):
+        """ Convert every check_interval seconds in a background thread. """
+        def run():
+            while True:
+                try:
+                    if self.converting():
+                        self.convert(index)
+                except Exception:
+                    traceback.print_exc()
+                time.sleep(self.check_interval)
+        worker = threading.Thread(target=run, name=self.threadname)
+        worker.daemon = True
+        worker.start()
+
+    def stats(self):
+        return {'built': self.built, 'failed': self.failed}
+
+
+class SidecarStore(Builder):
+    """ Sidecars of the day files of the datasets in a FileIndex. """
+    lockname = '.converter.lock'
+    threadname = 'hapi-sidecars'
+
+    def __init__(self, root, infodir, check_interval=300):
+        Builder.__init__(self, root, check_interval)
+        self.infodir = infodir
+
+    def path(self, datadir, day):
+        """ Sidecar of the DataFile day of dataset directory datadir. """
+        datadir = os.path.normpath(datadir)
+        return os.path.join(self.root, os.path.basename(datadir),
+                            os.path.relpath(day.path, datadir) + SUFFIX)
+
+    def load(self, datadir, day):
+        """ The day's sidecar as an open numpy NpzFile, or None if there
+        is none or its day file changed since. """
+        try:
+            npz = numpy.load(self.path(datadir, day))
+        except (OSError, ValueError):
+            return None
+        try:
+            (mtime, size) = npz['source']
+        except (KeyError, ValueError):
+            (mtime, size) = (None, None)
+        if mtime != day.mtime or size != day.size:
+            npz.close()
+            return None
+        return npz
+
+    def build(self, datadir, day, dtypes):
+        # parse one day file and save its columns; raises ValueError if
+        # it does not fit its info
+        with open(day.path, 'rb') as raw:
+            with hapi_output.open_decoded(raw, day.encoding) as fin:
+                data = fin.read()
+        if not data.strip():
+            raise ValueError("no records")
+        arrays = {'c%d' % li: col
+                  for (li, col) in enumerate(parse_columns(data, dtypes))}
+        arrays['source'] = numpy.array([day.mtime, day.size])
+        self.save(self.path(datadir, day), arrays)
+
+    def convert(self, index):
+        """ One pass: build the missing or outdated sidecars of every
+        dataset in index (a hapi_fileindex.FileIndex). """
+        seen = {}  # only the day files still there are remembered
+        for datadir in list(index.datasets):
+            id = os.path.basename(datadir)
+            try:
+                with open(os.path.join(self.infodir, id + '.json')) as fin:
+                    dtypes = column_dtypes(json.load(fin))
+            except (OSError, ValueError, KeyError):
+                continue
+            (starts, days) = index.dataset(datadir).files
+            for day in days:
+                if time.time() - day.mtime < self.check_interval:
+                    continue  # may still be growing
+                path = self.path(datadir, day)
+                if self.seen.get(path) == (day.mtime, day.size):
+                    seen[path] = self.seen[path]
+                    continue
+                npz = self.load(datadir, day)
+                if npz is not None:
+                    npz.close()
+                else:
+                    try:
+                        self.build(datadir, day, dtypes)
+                        self.built += 1
+                    except (OSError, EOFError, ValueError):
+                        self.failed += 1  # stays CSV until it changes
+                seen[path] = (day.mtime, day.size)
+        self.seen = seen
+
+
+# set by hapi_server.py when the config file has a sidecar_dir
+SIDECARS = None
@@ -0,0 +1,76 @@
+""" hapi_time.py, time parsing for the HAPI Python Server
+
+ Part of the HAPI Python Server.  The code and documentation resides at:
+    https://github.com/hapi-server/server-python
+
+ Every data request parses its time.min and time.max several times (query
+ checks, Last-Modified, cache key, reader, trimming), and the trimming
+ step parses record timestamps too.  HAPI times are restricted ISO 8601,
+ calendar (YYYY-MM-DDTHH:MM:SS.sssZ) or day-of-year (YYYY-DDDTHH:MM:SSZ)
+ with the trailing parts optional, so those are matched by one regular
+ expression; anything else falls back to dateutil.  Results are kept in
+ a small LRU cache, so repeated parses of the same string are free.
+
+ All times are naive datetimes in UTC.
+"""
+
+import datetime
+import functools
+import re
+
+from dateutil.parser import isoparse, parse
+
+# YYYY-MM-DD or YYYY-DDD, then optional THH, :MM, :SS, .fraction and Z
+HAPI_TIME = re.compile(
+    r'(\d{4})-(?:(\d\d)-(\d\d)|(\d{3}))'
+    r'(?:T(\d\d)(?::(\d\d)(?::(\d\d)(?:\.(\d+))?)?)?)?Z?$')
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_time(timestamp):
+    """ ISO 8601 time (calendar or YYYY-DOY, any precision) as a naive
+    UTC datetime; raises ValueError if it is not a time. """
+    match = HAPI_TIME.match(timestamp.strip())
+    if match is not None:
+        (yr, mo, dy, doy, hr, mn, sc, frac) = match.groups()
+        try:
+            if doy is not None:
+                dt = datetime.datetime(int(yr), 1, 1) + datetime.timedelta(
+                    days=int(doy) - 1)
+                if dt.year != int(yr) or doy == '000':
+                    raise ValueError("day of year out of range")
+            else:
+                dt = datetime.datetime(int(yr), int(mo), int(dy))
+            return dt.replace(hour=int(hr or 0), minute=int(mn or 0),
+                              second=int(sc or 0),
+                              microsecond=int((frac or '0')[:6].ljust(6, '0')))
+        except ValueError:
+            pass # e.g. 24:00 or a leap second; let dateutil decide
+    try:
+        dt = isoparse(timestamp.strip())
+    except ValueError:
+        dt = parse(timestamp)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def normalize_time(timestamp):
+    """ Request time as 'YYYY-MM-DDTHH:MM:SSZ', or with '.ffffff' when it
+    has a fraction of a second, so readers get the full precision asked. """
+    dt = parse_time(timestamp)
+    if dt.microsecond:
+        return dt.isoformat(timespec='microseconds') + 'Z'
+    return dt.isoformat(timespec='seconds') + 'Z'
+
+
+def time_key(timestamp):
+    """ ISO 8601 time as a 'YYYY-MM-DDTHH:MM:SS.ffffff' string, so times
+    compare as strings. """
+    return parse_time(timestamp).isoformat(timespec='microseconds')
+
+
+def epoch_seconds(timestamp):
+    """ ISO 8601 time as seconds since 1970 (UTC). """
+    return parse_time(timestamp).replace(
+        tzinfo=datetime.timezone.utc).timestamp()
@@ -2,12 +2,12 @@
 docs here later
 """
 
-import dateutil
 import datetime
 import madhapi_api
 import madrigalWeb.madrigalWeb
 import time
 import fnmatch
+from hapi_time import parse_time
 import populateMadHAPI
 
 
@@ -26,9 +26,9 @@ def do_data_madrigal(
     """
     do_data function like csv and supermag example
     """
-    timemin = dateutil.parser.parse(timemin)
+    timemin = parse_time(timemin)
     startDT = timemin.replace(tzinfo=datetime.timezone.utc)
-    timemax = dateutil.parser.parse(timemax)
+    timemax = parse_time(timemax)
     endDT = timemax.replace(tzinfo=datetime.timezone.utc)
 
     kinst, kindat = madhapi_api.madhapiID_toMadrigalID(id)
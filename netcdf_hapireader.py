@@ -46,6 +46,7 @@ import xarray as xr
 import os
 import datetime
 import re
+from hapi_time import parse_time
 #import s3netcdf
 
 # As per request by Bon to exclude one channel of data,
@@ -449,8 +450,9 @@ def do_data_netcdf(id, timemin, timemax, parameters, catalog, floc,
     # convert strings to datetimes to lists
     # e.g. 2021-03-18T03:00Z and 2021-03-18T05:00Z
     # to [2021, 3, 18, 3, 0, 0] and [2021, 3, 18, 5, 0, 0]
-    timestart = datetime.datetime.strptime(timemin,'%Y-%m-%dT%H:%MZ') 
-    timeend = datetime.datetime.strptime(timemax,'%Y-%m-%dT%H:%MZ')
+    # (times arrive as full-precision ISO 8601, see hapi_parser.normalize_time)
+    timestart = parse_time(timemin)
+    timeend = parse_time(timemax)
     timestartlist = list(timestart.timetuple())
     timeendlist = list(timeend.timetuple())
 
@@ -458,8 +460,8 @@ def do_data_netcdf(id, timemin, timemax, parameters, catalog, floc,
     year_end = timeend.strftime('%Y')
     doy_start = timestart.strftime('%j')
     doy_end = timeend.strftime('%j')
-    sec_start = '%06d' % (timestartlist[3]*60*60 + timestartlist[4]*60)
-    sec_end = '%06d' % (timeendlist[3]*60*60 + timeendlist[4]*60)
+    sec_start = '%06d' % (timestartlist[3]*60*60 + timestartlist[4]*60 + timestartlist[5])
+    sec_end = '%06d' % (timeendlist[3]*60*60 + timeendlist[4]*60 + timeendlist[5])
 
     #print("debug, hunting:",year_start,doy_start, sec_start)
     (flist,seconds) = find_netcdf_files(floc,year_start,year_end,doy_start,doy_end,sec_start,sec_end)
@@ -27,6 +27,7 @@ import json
 import re
 #from datetime import datetime, timedelta
 import datetime
+from hapi_time import parse_time
 
 from supermag_api import *
 
@@ -438,8 +439,9 @@ def do_data_supermag(id,timemin,timemax,parameters,catalog,floc,
 
     #timenow = datetime.datetime.strptime(timemin,'%Y-%m-%dT%H:%M:%SZ')
     #timeend = datetime.datetime.strptime(timemax,'%Y-%m-%dT%H:%M:%SZ')
-    start = datetime.datetime.strptime(timemin,'%Y-%m-%dT%H:%MZ')
-    timeend = datetime.datetime.strptime(timemax,'%Y-%m-%dT%H:%MZ')
+    # (times arrive as full-precision ISO 8601, see hapi_parser.normalize_time)
+    start = parse_time(timemin)
+    timeend = parse_time(timemax)
     delta=timeend-start
     extent = delta.total_seconds()
 
@@ -591,8 +593,8 @@ def do_file_supermag( id, timemin, timemax, parameters):
     #timemax= dateutil.parser.parse( timemax ).strftime('%Y-%m-%d-%H-%M-%S')
     #(yyyy,mo,dd,hh,mm,ss)=(int(x) for x in timemax.split('-'))
 
-    timenow = datetime.datetime.strptime(timemin,'%Y-%m-%dT%H:%M:%SZ')
-    timeend = datetime.datetime.strptime(timemax,'%Y-%m-%dT%H:%M:%SZ')
+    timenow = parse_time(timemin)
+    timeend = parse_time(timemax)
 
     if ( parameters!=None ):
         mp= do_parameters_map( id, parameters )